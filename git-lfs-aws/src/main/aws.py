@@ -1,21 +1,52 @@
+import base64
+import hashlib
+import hmac
 import json
 import logging
+import math
 import os
-from dataclasses import dataclass, field
-from typing import List, Dict, Any
+import re
+import string
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Set, Tuple
+from urllib.parse import quote, urlsplit, parse_qs
 
 import boto3
 from botocore.client import Config
+from botocore.exceptions import ClientError
 
 from core import *
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
+existence_cache = ExistenceCache(
+    max_size=int(os.getenv('EXISTS_CACHE_SIZE', '0')),
+    negative_ttl=float(os.getenv('EXISTS_CACHE_NEGATIVE_TTL', '0'))
+)
+
+presign_cache = PresignCache(
+    max_size=int(os.getenv('PRESIGN_CACHE_SIZE', '0')),
+    min_lifetime=float(os.getenv('PRESIGN_CACHE_MIN_LIFETIME', '900'))
+)
+
+registry = Registry()
+
+_UNRESERVED_KEY = re.compile(r'[A-Za-z0-9/_.~-]*')
+_S3_MIN_PART_SIZE = 5 * 1024 * 1024
+_S3_MAX_PARTS = 10000
+
 __all__ = (
     'ProxyRequest',
     'ProxyResponse',
+    'SigV4Presigner',
     'S3LargeFileStorage',
+    'EndpointLargeFileStorage',
+    'MultipartCompleteFacade',
     'Factory',
 
     'process',
@@ -37,21 +68,84 @@ class ProxyRequest:
     request_context: Dict[str, Any]
     body: str
     is_base64_encoded: bool
+    version: str
 
     def __init__(self, request):
-        self.resource = request.get('resource')
-        self.path = request.get('path')
-        self.http_method = request.get('httpMethod')
-        self.headers = request.get('headers', dict())
-        self.multi_value_headers = request.get('multiValueHeaders', dict())
+        self.version = request.get('version', '1.0')
+        self.headers = KeyInsensitiveDict(request.get('headers') or {})
         self.query_string_parameters = request.get('queryStringParameters', dict())
-        self.multi_value_query_string_parameters = request.get('multiValueQueryStringParameters', dict())
         self.path_parameters = request.get('pathParameters', dict())
         self.stage_variables = request.get('stageVariables', dict())
         self.request_context = request.get('requestContext', dict())
         self.body = request.get('body')
         self.is_base64_encoded = request.get('isBase64Encoded')
 
+        if self.version == '2.0':
+            # HTTP API payload format 2.0 keeps the stage in the raw path and has no multi-value maps
+            stage = self.request_context.get('stage', '$default')
+            path = request.get('rawPath', '/')
+            self.resource = request.get('routeKey')
+            self.path = path[len(stage) + 1:] if stage != '$default' and path.startswith(f'/{stage}/') else path
+            self.http_method = self.request_context.get('http', dict()).get('method')
+            self.multi_value_headers = dict()
+            self.multi_value_query_string_parameters = dict()
+        else:
+            self.resource = request.get('resource')
+            self.path = request.get('path')
+            self.http_method = request.get('httpMethod')
+            self.multi_value_headers = request.get('multiValueHeaders', dict())
+            self.multi_value_query_string_parameters = request.get('multiValueQueryStringParameters', dict())
+
+    @property
+    def endpoint(self) -> str:
+        host = self.request_context.get('domainName') or self.headers.get('Host')
+        stage = self.request_context.get('stage')
+        return f'https://{host}/' if stage == '$default' else f'https://{host}/{stage}/'
+
+    def decoded_body(self, max_size: int) -> Optional[str]:
+        if self.body is None:
+            return None
+
+        body = base64.b64decode(self.body) if self.is_base64_encoded else self.body.encode()
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding == 'gzip':
+            body = self.decompress(body, 16 + zlib.MAX_WBITS, max_size)
+        elif encoding == 'deflate':
+            # some clients send raw deflate streams without the zlib wrapper
+            body = self.decompress(body, zlib.MAX_WBITS if self.zlib_wrapped(body) else -zlib.MAX_WBITS, max_size)
+        elif encoding != 'identity':
+            raise HttpError(415, 'Unsupported Media Type')
+
+        try:
+            return body.decode('utf-8')
+        except UnicodeDecodeError:
+            raise HttpError(400, 'Bad Request')
+
+    @staticmethod
+    def zlib_wrapped(body: bytes) -> bool:
+        try:
+            zlib.decompressobj().decompress(body[:2])
+        except zlib.error:
+            return False
+
+        return True
+
+    @staticmethod
+    def decompress(body: bytes, wbits: int, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            data = decompressor.decompress(body, max_size + 1)
+        except zlib.error:
+            raise HttpError(400, 'Bad Request')
+
+        if len(data) > max_size:
+            raise HttpError(413, 'Payload Too Large')
+
+        if not decompressor.eof:
+            raise HttpError(400, 'Bad Request')
+
+        return data
+
 
 @dataclass
 class ProxyResponse:
@@ -61,65 +155,587 @@ class ProxyResponse:
     headers: Dict[str, str] = field(default_factory=dict)
     multi_value_headers: Dict[str, List[str]] = field(default_factory=dict)
 
-    def as_dict(self):
+    def as_dict(self, compressor: ResponseCompressor = None, accept_encoding: str = None):
+        body, headers, is_base64_encoded = json.dumps(self.body), self.headers, self.is_base64_encoded
+        if compressor is not None:
+            data, encoding = compressor.compress(body.encode(), accept_encoding)
+            if encoding is not None:
+                body = base64.b64encode(data).decode()
+                headers = {**headers, **ResponseCompressor.headers(encoding)}
+                is_base64_encoded = True
+
         return {
-            'isBase64Encoded': self.is_base64_encoded,
+            'isBase64Encoded': is_base64_encoded,
             'statusCode': self.status_code,
-            'headers': self.headers,
+            'headers': headers,
             'multiValueHeaders': self.multi_value_headers,
-            'body': json.dumps(self.body)
+            'body': body
         }
 
 
+class SigV4Presigner:
+    methods = {
+        'get_object': 'GET',
+        'put_object': 'PUT',
+        'upload_part': 'PUT',
+        'abort_multipart_upload': 'DELETE'
+    }
+    parameters = {
+        'PartNumber': 'partNumber',
+        'UploadId': 'uploadId'
+    }
+
+    def __init__(self, credentials, region: str, endpoint: str,
+                 clock: Callable[[], datetime] = lambda: datetime.now(timezone.utc)):
+        parts = urlsplit(endpoint)
+        self.credentials = credentials
+        self.region = region
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.path = parts.path.rstrip('/')
+        self.clock = clock
+        self.signing_key: Tuple[Tuple[str, str, str], bytes] = (('', '', ''), b'')
+        self.auth: Tuple[Any, Tuple[str, List[Tuple[str, str]], str, str]] = (None, ('', [], '', ''))
+
+    @staticmethod
+    def from_client(s3, bucket_name: str) -> Optional['SigV4Presigner']:
+        credentials = s3._request_signer._credentials
+        if credentials is None:
+            return None
+
+        # botocore resolves the addressing style, endpoint and signing region once
+        url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket_name, 'Key': '_'}, ExpiresIn=1)
+        scope = parse_qs(urlsplit(url).query)['X-Amz-Credential'][0].split('/')
+        return SigV4Presigner(credentials, scope[2], url.split('?', 1)[0][:-1])
+
+    def presign(self, action: str, key: str, expires_in: int = 3600, params: Dict[str, Any] = None) -> str:
+        credentials = self.credentials.get_frozen_credentials()
+        timestamp = self.clock().strftime('%Y%m%dT%H%M%SZ')
+        scope, query, canonical_query, query_string = self.auth_query(timestamp, expires_in, credentials)
+
+        if params:
+            query = [(self.parameters[k], quote(str(v), safe='-_.~')) for k, v in params.items()] + query
+            canonical_query = '&'.join(f'{k}={v}' for k, v in sorted(query))
+            query_string = '&'.join(f'{k}={v}' for k, v in query)
+
+        path = f'{self.path}/{key if _UNRESERVED_KEY.fullmatch(key) else quote(key, safe="/~")}'
+        canonical_request = (
+            f'{self.methods[action]}\n{path}\n{canonical_query}\nhost:{self.host}\n\nhost\nUNSIGNED-PAYLOAD'
+        )
+        string_to_sign = (
+            f'AWS4-HMAC-SHA256\n{timestamp}\n{scope}\n{hashlib.sha256(canonical_request.encode()).hexdigest()}'
+        )
+        signature = hmac.digest(
+            self.derive_signing_key(timestamp[:8], credentials), string_to_sign.encode(), 'sha256'
+        ).hex()
+
+        return f'{self.scheme}://{self.host}{path}?{query_string}&X-Amz-Signature={signature}'
+
+    def auth_query(self, timestamp: str, expires_in: int, credentials) -> Tuple[str, List[Tuple[str, str]], str, str]:
+        cache_key = (timestamp, expires_in, credentials)
+        cached_key, auth = self.auth
+        if cached_key == cache_key:
+            return auth
+
+        scope = f'{timestamp[:8]}/{self.region}/s3/aws4_request'
+        query = [
+            ('X-Amz-Algorithm', 'AWS4-HMAC-SHA256'),
+            ('X-Amz-Credential', quote(f'{credentials.access_key}/{scope}', safe='-_.~')),
+            ('X-Amz-Date', timestamp),
+            ('X-Amz-Expires', str(expires_in)),
+            ('X-Amz-SignedHeaders', 'host')
+        ]
+        if credentials.token:
+            query.append(('X-Amz-Security-Token', quote(credentials.token, safe='-_.~')))
+
+        auth = (
+            scope,
+            query,
+            '&'.join(f'{k}={v}' for k, v in sorted(query)),
+            '&'.join(f'{k}={v}' for k, v in query)
+        )
+        self.auth = (cache_key, auth)
+        return auth
+
+    def derive_signing_key(self, date: str, credentials) -> bytes:
+        cache_key = (date, credentials.access_key, credentials.secret_key)
+        cached_key, signing_key = self.signing_key
+        if cached_key == cache_key:
+            return signing_key
+
+        signing_key = f'AWS4{credentials.secret_key}'.encode()
+        for message in (date, self.region, 's3', 'aws4_request'):
+            signing_key = hmac.digest(signing_key, message.encode(), 'sha256')
+
+        self.signing_key = (cache_key, signing_key)
+        return signing_key
+
+
 class S3LargeFileStorage(LargeFileStorage):
 
-    def __init__(self) -> None:
+    def __init__(self, layout: KeyLayout = None, head_threshold: int = 2, local_presign: bool = False,
+                 multipart_threshold: int = None, max_workers: int = 16) -> None:
         self.bucket_name = os.getenv('S3_BUCKET_NAME')
+        self.layout = layout or KeyLayout()
+        self.head_threshold = head_threshold
+        self.local_presign = local_presign
+        self.multipart_threshold = multipart_threshold
+        self.presigner: Optional[SigV4Presigner] = None
+        self.max_workers = max(max_workers, 1)
+        self.density: Optional[float] = None
+        self.executor = ThreadPoolExecutor(max_workers, 'git-lfs-s3') if max_workers > 1 else None
         self.s3 = boto3.client(
             service_name='s3',
-            config=Config(signature_version='s3v4')
+            config=Config(signature_version='s3v4', max_pool_connections=max(max_workers, 10))
         )
 
     def exists(self, oid: str) -> bool:
+        return self.layout.find(oid, self.key_exists) is not None
+
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        candidates = {oid: self.layout.keys(oid) for oid in oids}
+        found = self.keys_exist(sorted({key for keys in candidates.values() for key in keys}))
+        return {oid for oid in candidates if self.layout.match(oid, found) is not None}
+
+    def key_exists(self, key: str) -> bool:
         res = self.s3.list_objects_v2(
             Bucket=self.bucket_name,
-            Prefix=oid,
+            Prefix=key,
             MaxKeys=1
         )
 
-        return 'Contents' in res
+        return any(obj['Key'] == key for obj in res.get('Contents', []))
+
+    def keys_exist(self, keys: List[str]) -> Set[str]:
+        return set(self.key_sizes(keys))
+
+    def key_sizes(self, keys: List[str]) -> Dict[str, int]:
+        if len(keys) <= self.head_threshold:
+            return self.head_sizes(keys)
+
+        # sorted keys are answered by listing sweeps; each sweep starts right before the
+        # first unresolved key, so ranges without requested keys are never paged through
+        prefix = os.path.commonprefix([keys[0], keys[-1]])
+        found, i, start_after = {}, 0, ''
+        while i < len(keys):
+            if self.prefer_heads(keys[i:], prefix):
+                found.update(self.head_sizes(keys[i:]))
+                break
+
+            start_after = max(start_after, keys[i][:-1])
+            res = self.s3.list_objects_v2(
+                Bucket=self.bucket_name,
+                Prefix=prefix,
+                StartAfter=start_after,
+                MaxKeys=1000
+            )
+
+            contents = res.get('Contents', [])
+            listed = {obj['Key']: obj['Size'] for obj in contents}
+            if not res.get('IsTruncated') or not contents:
+                found.update((key, listed[key]) for key in keys[i:] if key in listed)
+                break
+
+            self.measure_density(contents, prefix)
+            start_after = contents[-1]['Key']
+            while i < len(keys) and keys[i] <= start_after:
+                if keys[i] in listed:
+                    found[keys[i]] = listed[keys[i]]
+                i += 1
+
+        return found
+
+    def head_sizes(self, keys: List[str]) -> Dict[str, int]:
+        if self.executor is None or len(keys) < 2:
+            sizes = zip(keys, map(self.key_size, keys))
+        else:
+            sizes = zip(keys, self.executor.map(self.key_size, keys))
+
+        return {key: size for key, size in sizes if size is not None}
+
+    def prefer_heads(self, keys: List[str], prefix: str) -> bool:
+        if self.density is None:
+            return False
+
+        # a page of 1000 stored keys covers 1000 / density of the key space; the sweeps needed are the
+        # pages over the batch's range that hold at least one requested key, against HEADs run in parallel
+        span = self.keyspace_position(keys[-1], prefix) - self.keyspace_position(keys[0], prefix)
+        pages = max(1.0, self.density * span * self.keyspace_scale(prefix) / 1000)
+        sweeps = pages * -math.expm1(-len(keys) / pages)
+        return len(keys) / self.max_workers <= sweeps
+
+    def measure_density(self, contents: List[Dict[str, Any]], prefix: str) -> None:
+        span = self.keyspace_position(contents[-1]['Key'], prefix) - self.keyspace_position(contents[0]['Key'], prefix)
+        if span > 0:
+            self.density = len(contents) / (span * self.keyspace_scale(prefix))
+
+    @staticmethod
+    def keyspace_position(key: str, prefix: str) -> float:
+        # oids are uniformly spread hex digits, so the digits past the prefix place a key in the key space
+        digits = ''.join(char for char in key[len(prefix):] if char in string.hexdigits)[:12]
+        return int(digits.ljust(12, '0'), 16) / 16 ** 12
+
+    @staticmethod
+    def keyspace_scale(prefix: str) -> float:
+        return 16.0 ** -sum(1 for char in prefix if char in string.hexdigits)
+
+    def size(self, oid: str) -> Optional[int]:
+        keys = self.layout.keys(oid)
+        for key in keys:
+            size = self.key_size(key)
+            if size is not None:
+                self.layout.remember(oid, keys, key)
+                return size
+
+        self.layout.remember(oid, keys, None)
+        return None
+
+    def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        candidates = {oid: self.layout.keys(oid) for oid in oids}
+        sizes = self.key_sizes(sorted({key for keys in candidates.values() for key in keys}))
+
+        found = {}
+        for oid in candidates:
+            key = self.layout.match(oid, sizes)
+            if key is not None:
+                found[oid] = sizes[key]
+        return found
+
+    def key_size(self, key: str) -> Optional[int]:
+        try:
+            res = self.s3.head_object(
+                Bucket=self.bucket_name,
+                Key=key
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+        return res['ContentLength']
 
     def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         return BatchResponse.ObjectLfs.Action(
-            href=self.presign('get_object', oid)
+            href=self.presign('get_object', self.layout.locate(oid, self.key_exists))
         )
 
     def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         return BatchResponse.ObjectLfs.Action(
-            href=self.presign('put_object', oid)
+            href=self.presign('put_object', self.layout.key(oid))
+        )
+
+    def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        if self.multipart_threshold is None or size <= self.multipart_threshold:
+            return super().prepare_multipart_upload(oid, size, part_size)
+
+        # S3 accepts at most 10000 parts, each of at least 5 MiB except for the last one
+        part_size = max(part_size, _S3_MIN_PART_SIZE, -(-size // _S3_MAX_PARTS))
+        key = self.layout.key(oid)
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=key
+        )['UploadId']
+
+        return MultipartUpload(
+            parts=[
+                BatchResponse.ObjectLfs.Action(
+                    href=self.presign('upload_part', key, {'PartNumber': number, 'UploadId': upload_id}),
+                    pos=pos,
+                    size=min(part_size, size - pos)
+                )
+                for number, pos in enumerate(range(0, size, part_size), 1)
+            ],
+            commit=BatchResponse.ObjectLfs.Action(
+                href=f'objects/multipart/complete?uploadId={quote(upload_id, safe="")}',
+                header={
+                    'Accept': 'application/vnd.git-lfs+json'
+                }
+            ),
+            abort=BatchResponse.ObjectLfs.Action(
+                href=self.presign('abort_multipart_upload', key, {'UploadId': upload_id})
+            )
         )
 
-    def presign(self, action: str, oid: str) -> str:
+    def list_parts(self, oid: str, upload_id: str) -> Optional[List[Dict[str, Any]]]:
+        parts, marker = [], 0
+        while True:
+            try:
+                res = self.s3.list_parts(
+                    Bucket=self.bucket_name,
+                    Key=self.layout.key(oid),
+                    UploadId=upload_id,
+                    PartNumberMarker=marker
+                )
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchUpload'):
+                    return None
+                raise
+
+            parts.extend(res.get('Parts', []))
+            if not res.get('IsTruncated'):
+                return parts
+
+            marker = res['NextPartNumberMarker']
+
+    def complete_multipart_upload(self, oid: str, upload_id: str, parts: List[Dict[str, Any]]) -> None:
+        self.s3.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.layout.key(oid),
+            UploadId=upload_id,
+            MultipartUpload={
+                'Parts': [{'ETag': part['ETag'], 'PartNumber': part['PartNumber']} for part in parts]
+            }
+        )
+
+    def read_object(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        try:
+            res = self.s3.get_object(
+                Bucket=self.bucket_name,
+                Key=key
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None, None
+            raise
+
+        return res['Body'].read(), res['ETag']
+
+    def write_object(self, key: str, data: bytes, etag: Optional[str]) -> bool:
+        try:
+            self.s3.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=data,
+                **({'IfMatch': etag} if etag else {'IfNoneMatch': '*'})
+            )
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('412', 'PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+
+        return True
+
+    def iter_oids(self) -> Iterator[str]:
+        kwargs = {}
+        while True:
+            res = self.s3.list_objects_v2(
+                Bucket=self.bucket_name,
+                **kwargs
+            )
+
+            yield from oids_of(obj['Key'] for obj in res.get('Contents', []))
+            if not res.get('IsTruncated'):
+                return
+
+            kwargs['ContinuationToken'] = res['NextContinuationToken']
+
+    def presign(self, action: str, key: str, params: Dict[str, Any] = None) -> str:
+        if self.local_presign:
+            if self.presigner is None:
+                self.presigner = SigV4Presigner.from_client(self.s3, self.bucket_name)
+            if self.presigner is not None:
+                return self.presigner.presign(action, key, 3600, params)
+
         return self.s3.generate_presigned_url(
             action,
             Params={
                 'Bucket': self.bucket_name,
-                'Key': oid
+                'Key': key,
+                **(params or {})
             },
             ExpiresIn=3600
         )
 
 
+class EndpointLargeFileStorage(LargeFileStorageWrapper):
+
+    def __init__(self, lfs: LargeFileStorage, endpoint: str):
+        super().__init__(lfs)
+        self.endpoint = endpoint
+
+    def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        upload = self.lfs.prepare_multipart_upload(oid, size, part_size)
+        if self.endpoint and upload.commit is not None and '://' not in upload.commit.href:
+            upload.commit = replace(upload.commit, href=f'{self.endpoint}{upload.commit.href}')
+        return upload
+
+
+class MultipartCompleteFacade:
+
+    def __init__(self, lfs: LargeFileStorage, instrumentation: Instrumentation = None, oid_index: OidIndex = None,
+                 existence_cache: ExistenceCache = None):
+        self.instrumentation = instrumentation or Instrumentation()
+        self.oid_index = oid_index
+        self.existence_cache = existence_cache
+        self.lfs = lfs
+        if type(self.instrumentation).record is not Instrumentation.record:
+            self.lfs = InstrumentedLargeFileStorage(lfs, self.instrumentation)
+
+    def process(self, request: HttpRequest) -> HttpResponse:
+        with self.instrumentation.measure('parse'):
+            verify_request, upload_id = self.parse_request(request)
+
+        with self.instrumentation.measure('complete', 1):
+            self.complete(verify_request, upload_id)
+
+        return HttpResponse(
+            status_code=200,
+            headers={
+                'Content-Type': 'application/vnd.git-lfs+json'
+            },
+            body=verify_request
+        )
+
+    @staticmethod
+    def parse_request(request: HttpRequest) -> Tuple[VerifyRequest, str]:
+        if request.path != '/objects/multipart/complete' or request.method != 'POST':
+            raise HttpError(404, 'Not found')
+
+        if 'application/vnd.git-lfs+json' not in request.headers.get('Accept', ''):
+            raise HttpError(406, 'Not Acceptable')
+
+        body = json.loads(request.body)
+        upload_id = (request.parameters or {}).get('uploadId')
+        if not isinstance(body.get('oid'), str) or type(body.get('size')) is not int or not upload_id:
+            raise HttpError(422, 'Unprocessable Entity')
+
+        return VerifyRequest(body['oid'], body['size']), upload_id
+
+    def complete(self, request: VerifyRequest, upload_id: str) -> None:
+        if BatchFacade.validate_object(BatchRequest.ObjectLfs(request.oid, request.size)) is not None:
+            raise HttpError(422, 'Unprocessable Entity')
+
+        parts = self.lfs.list_parts(request.oid, upload_id)
+        if parts is None:
+            raise HttpError(404, 'The multipart upload does not exist on the server')
+
+        if not parts or sum(part['Size'] for part in parts) != request.size:
+            raise HttpError(422, 'The object size does not match')
+
+        self.lfs.complete_multipart_upload(request.oid, upload_id, parts)
+        if self.existence_cache is not None:
+            self.existence_cache.put(request.oid, True)
+        if self.oid_index is not None:
+            self.oid_index.add([request.oid])
+
+
 class Factory:
     @staticmethod
-    def create_batch_facade():
-        return BatchFacade(S3LargeFileStorage())
+    def create_large_file_storage():
+        lfs = S3LargeFileStorage(
+            Factory.create_key_layout(),
+            head_threshold=int(os.getenv('S3_HEAD_THRESHOLD', '2')),
+            local_presign=os.getenv('S3_LOCAL_PRESIGN', 'true').lower() == 'true',
+            multipart_threshold=int(os.getenv('S3_MULTIPART_THRESHOLD', '104857600')),
+            max_workers=int(os.getenv('S3_MAX_CONNECTIONS', '16'))
+        )
+        if existence_cache.enabled:
+            lfs = CachingLargeFileStorage(lfs, existence_cache)
+        if presign_cache.enabled:
+            lfs = PresignCachingLargeFileStorage(lfs, presign_cache, expires_in=3600)
+        return lfs
+
+    @staticmethod
+    def large_file_storage():
+        return registry.get('large_file_storage', Factory.create_large_file_storage)
+
+    @staticmethod
+    def create_oid_index(lfs: LargeFileStorage):
+        if os.getenv('OID_INDEX', 'false').lower() != 'true':
+            return None
+
+        key = os.getenv('OID_INDEX_KEY', '.lfs/oids.bloom')
+        return OidIndex(
+            lambda: lfs.read_object(key),
+            lambda data, etag: lfs.write_object(key, data, etag),
+            scan=lfs.iter_oids,
+            capacity=int(os.getenv('OID_INDEX_CAPACITY', '1000000')),
+            error_rate=float(os.getenv('OID_INDEX_ERROR_RATE', '0.01')),
+            max_age=float(os.getenv('OID_INDEX_MAX_AGE', '60'))
+        )
+
+    @staticmethod
+    def oid_index():
+        lfs = Factory.large_file_storage()
+        return registry.get('oid_index', lambda: Factory.create_oid_index(lfs))
+
+    @staticmethod
+    def reset():
+        registry.reset()
+        existence_cache.clear()
+        presign_cache.clear()
+
+    @staticmethod
+    def create_key_layout():
+        return KeyLayout.create(
+            os.getenv('KEY_LAYOUT', 'flat'),
+            prefix=os.getenv('KEY_PREFIX', ''),
+            legacy=KeyLayout() if os.getenv('KEY_LEGACY_FALLBACK', 'true').lower() == 'true' else None
+        )
+
+    @staticmethod
+    def create_instrumentation():
+        if os.getenv('LOG_METRICS', 'false').lower() == 'true':
+            return LoggingInstrumentation(logger)
+        if os.getenv('LOG_SUMMARY', 'true').lower() == 'true':
+            return SummaryInstrumentation(logger)
+        return Instrumentation()
+
+    @staticmethod
+    def create_batch_facade(endpoint: str = None):
+        return BatchFacade(
+            EndpointLargeFileStorage(Factory.large_file_storage(), os.getenv('LFS_ENDPOINT', endpoint)),
+            executor=shared_executor(int(os.getenv('BATCH_MAX_WORKERS', '0'))),
+            max_concurrency=int(os.getenv('BATCH_MAX_CONCURRENCY', '0')) or None,
+            instrumentation=Factory.create_instrumentation(),
+            skip_existing_uploads=os.getenv('SKIP_EXISTING_UPLOADS', 'true').lower() == 'true',
+            verify_upload_size=os.getenv('VERIFY_UPLOAD_SIZE', 'false').lower() == 'true',
+            verify_endpoint=Factory.create_verify_endpoint(endpoint),
+            part_size=int(os.getenv('MULTIPART_PART_SIZE', '0')) or None,
+            oid_index=Factory.oid_index()
+        )
+
+    @staticmethod
+    def create_response_compressor(version: str = '1.0'):
+        # REST APIs only decode base64 responses with binary media types configured, HTTP APIs always do
+        if os.getenv('COMPRESS_RESPONSES', 'true' if version == '2.0' else 'false').lower() != 'true':
+            return None
+        return ResponseCompressor(min_size=int(os.getenv('COMPRESS_MIN_SIZE', '1024')))
+
+    @staticmethod
+    def create_verify_endpoint(endpoint: str = None):
+        if os.getenv('VERIFY_UPLOADS', 'true').lower() != 'true':
+            return None
+        return os.getenv('LFS_ENDPOINT', endpoint)
+
+    @staticmethod
+    def create_verify_facade():
+        return VerifyFacade(
+            Factory.large_file_storage(),
+            instrumentation=Factory.create_instrumentation(),
+            oid_index=Factory.oid_index()
+        )
+
+    @staticmethod
+    def create_multipart_complete_facade():
+        return MultipartCompleteFacade(
+            Factory.large_file_storage(),
+            instrumentation=Factory.create_instrumentation(),
+            oid_index=Factory.oid_index(),
+            existence_cache=existence_cache if existence_cache.enabled else None
+        )
 
 
 def process(request: ProxyRequest, context) -> ProxyResponse:
+    start = time.perf_counter()
+    facade, status = None, 500
     try:
         if request.path == '/objects/batch':
-            facade = Factory.create_batch_facade()
+            facade = Factory.create_batch_facade(request.endpoint)
+        elif request.path == '/objects/verify':
+            facade = Factory.create_verify_facade()
+        elif request.path == '/objects/multipart/complete':
+            facade = Factory.create_multipart_complete_facade()
         else:
             raise HttpError(404, 'Not found')
 
@@ -129,17 +745,22 @@ def process(request: ProxyRequest, context) -> ProxyResponse:
                 method=request.http_method,
                 headers=request.headers,
                 parameters=request.query_string_parameters,
-                body=request.body
+                body=request.decoded_body(int(os.getenv('MAX_BODY_SIZE', '67108864')))
             )
         )
 
+        with facade.instrumentation.measure('serialize'):
+            body = dataclass_as_dict(response.body)
+
+        status = response.status_code
         return ProxyResponse(
             status_code=response.status_code,
             headers=response.headers,
-            body=dataclass_as_dict(response.body)
+            body=body
         )
 
     except HttpError as e:
+        status = e.code
         return ProxyResponse(
             status_code=e.code,
             body={
@@ -158,9 +779,23 @@ def process(request: ProxyRequest, context) -> ProxyResponse:
             }
         )
 
+    finally:
+        if facade is not None:
+            facade.instrumentation.annotate(
+                status=status,
+                duration=round(time.perf_counter() - start, 6),
+                request_id=context.aws_request_id
+            )
+            facade.instrumentation.flush()
+
 
 def lambda_handler(request, context):
-    logger.info('ProxyRequest: %s' % json.dumps(request))
-    response = process(ProxyRequest(request), context)
-    logger.info('ProxyResponse: %s' % json.dumps(response.as_dict()))
-    return response.as_dict()
+    level = payload_log_level(float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0')))
+    logger.log(level, 'ProxyRequest: %s', LazyJson(request))
+    proxy_request = ProxyRequest(request)
+    response = process(proxy_request, context).as_dict(
+        Factory.create_response_compressor(proxy_request.version),
+        proxy_request.headers.get('Accept-Encoding')
+    )
+    logger.log(level, 'ProxyResponse: %s', LazyJson(response))
+    return response
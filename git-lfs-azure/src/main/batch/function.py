@@ -1,11 +1,20 @@
+import base64
+import hmac
 import json
 import logging
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote
 
 import azure.functions as func
+import requests
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
 from azure.storage.blob import blockblobservice, BlobPermissions
+from azure.storage.blob._constants import X_MS_VERSION
 
 try:
     from ..core import *
@@ -15,7 +24,20 @@ except:
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
+existence_cache = ExistenceCache(
+    max_size=int(os.getenv('EXISTS_CACHE_SIZE', '0')),
+    negative_ttl=float(os.getenv('EXISTS_CACHE_NEGATIVE_TTL', '0'))
+)
+
+presign_cache = PresignCache(
+    max_size=int(os.getenv('PRESIGN_CACHE_SIZE', '0')),
+    min_lifetime=float(os.getenv('PRESIGN_CACHE_MIN_LIFETIME', '900'))
+)
+
+registry = Registry()
+
 __all__ = (
+    'SharedAccessSignatureBuilder',
     'BlobLargeFileStorage',
     'Factory',
 
@@ -24,36 +46,184 @@ __all__ = (
 )
 
 
+class SharedAccessSignatureBuilder:
+
+    def __init__(self, account_name: str, account_key: str, container_name: str, version: str = X_MS_VERSION):
+        self.account_key = base64.b64decode(account_key)
+        self.resource = f'/blob/{account_name}/{container_name}/'
+        self.version = version
+        self.fields: Tuple[Any, Tuple[str, str, str]] = (None, ('', '', ''))
+
+    def generate(self, key: str, permission: str, expiry: datetime) -> str:
+        prefix, suffix, query = self.signed_fields(permission, expiry)
+        signature = base64.b64encode(
+            hmac.digest(self.account_key, f'{prefix}{key}{suffix}'.encode(), 'sha256')
+        ).decode()
+
+        return f'{query}&sig={quote(signature)}'
+
+    def signed_fields(self, permission: str, expiry: datetime) -> Tuple[str, str, str]:
+        cache_key = (permission, expiry)
+        cached_key, fields = self.fields
+        if cached_key == cache_key:
+            return fields
+
+        # the same layout as azure-storage-blob: sp, st, se, resource, si, sip, spr, sv and five response headers
+        se = expiry.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        fields = (
+            f'{permission}\n\n{se}\n{self.resource}',
+            f'\n\n\n\n{self.version}\n\n\n\n\n',
+            f'se={quote(se)}&sp={quote(permission)}&sv={self.version}&sr=b'
+        )
+        self.fields = (cache_key, fields)
+        return fields
+
+
 class BlobLargeFileStorage(LargeFileStorage):
 
-    def __init__(self, env=os.environ):
+    def __init__(self, env=os.environ, layout: KeyLayout = None, local_sas: bool = False, head_threshold: int = 100,
+                 max_workers: int = 16, clock: Callable[[], float] = time.time):
+        self.layout = layout or KeyLayout()
+        self.head_threshold = head_threshold
         self.storage_account_name = env['STORAGE_ACCOUNT']
         self.storage_account_primary_key = env['STORAGE_ACCOUNT_PRIMARY_KEY']
         self.storage_container_name = env['STORAGE_CONTAINER']
+        self.local_sas = local_sas
+        self.clock = clock
+        self.sas_builder: Optional[SharedAccessSignatureBuilder] = None
+        self.expiry: Tuple[int, datetime] = (0, datetime.fromtimestamp(0, timezone.utc))
+        self.executor = ThreadPoolExecutor(max_workers, 'git-lfs-azure') if max_workers > 1 else None
         self.client = blockblobservice.BlockBlobService(
             account_name=self.storage_account_name,
-            account_key=self.storage_account_primary_key
+            account_key=self.storage_account_primary_key,
+            request_session=self.create_session(max_workers)
         )
 
+    @staticmethod
+    def create_session(max_workers: int) -> requests.Session:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(max_workers, 10))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
     def exists(self, oid: str) -> bool:
-        return self.client.exists(self.storage_container_name, oid)
+        return self.layout.find(oid, self.key_exists) is not None
+
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        return set(self.sizes_many(oids))
+
+    def key_exists(self, key: str) -> bool:
+        return self.client.exists(self.storage_container_name, key)
+
+    def size(self, oid: str) -> Optional[int]:
+        keys = self.layout.keys(oid)
+        for key in keys:
+            size = self.key_size(key)
+            if size is not None:
+                self.layout.remember(oid, keys, key)
+                return size
+
+        self.layout.remember(oid, keys, None)
+        return None
+
+    def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        candidates = {oid: self.layout.keys(oid) for oid in oids}
+        sizes = self.key_sizes(sorted({key for keys in candidates.values() for key in keys}))
+
+        found = {}
+        for oid in candidates:
+            key = self.layout.match(oid, sizes)
+            if key is not None:
+                found[oid] = sizes[key]
+        return found
+
+    def key_size(self, key: str) -> Optional[int]:
+        try:
+            blob = self.client.get_blob_properties(self.storage_container_name, key)
+        except AzureMissingResourceHttpError:
+            return None
+
+        return blob.properties.content_length
+
+    def key_sizes(self, keys: List[str]) -> Dict[str, int]:
+        prefixes = self.sweep_prefixes(keys)
+        if prefixes is None:
+            sizes = zip(keys, self.map(self.key_size, keys))
+            return {key: size for key, size in sizes if size is not None}
+
+        wanted = set(keys)
+        found = {}
+        for listed in self.map(lambda prefix: self.list_sizes(prefix, wanted), prefixes):
+            found.update(listed)
+        return found
+
+    def sweep_prefixes(self, keys: List[str]) -> Optional[List[str]]:
+        if len(keys) <= self.head_threshold:
+            return None
+
+        # List Blobs has no start-after, so sorted keys are swept by the prefixes two characters past
+        # their common prefix; a batch too sparse to share those prefixes is cheaper as HEAD requests
+        depth = len(os.path.commonprefix([keys[0], keys[-1]])) + 2
+        prefixes = sorted({key[:depth] for key in keys})
+        if len(prefixes) * 4 > len(keys):
+            return None
+
+        return prefixes
+
+    def list_sizes(self, prefix: str, wanted: Set[str]) -> Dict[str, int]:
+        return {
+            blob.name: blob.properties.content_length
+            for blob in self.client.list_blobs(self.storage_container_name, prefix=prefix)
+            if blob.name in wanted
+        }
+
+    def map(self, fn: Callable[[str], Any], items: List[str]) -> List[Any]:
+        if self.executor is None or len(items) < 2:
+            return [fn(item) for item in items]
+
+        return list(self.executor.map(fn, items))
+
+    def read_object(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        try:
+            blob = self.client.get_blob_to_bytes(self.storage_container_name, key)
+        except AzureMissingResourceHttpError:
+            return None, None
+
+        return blob.content, blob.properties.etag
+
+    def write_object(self, key: str, data: bytes, etag: Optional[str]) -> bool:
+        try:
+            self.client.create_blob_from_bytes(
+                self.storage_container_name, key, data,
+                **({'if_match': etag} if etag else {'if_none_match': '*'})
+            )
+        except AzureHttpError as e:
+            if e.status_code in (409, 412):
+                return False
+            raise
+
+        return True
+
+    def iter_oids(self) -> Iterator[str]:
+        return oids_of(self.client.list_blob_names(self.storage_container_name))
 
     def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
-        expiry = datetime.utcnow().replace(microsecond=0, tzinfo=timezone.utc) + timedelta(hours=1)
+        expiry = self.batch_expiry()
 
         return BatchResponse.ObjectLfs.Action(
             href=self.generate_blob_shared_access_signature_url(
-                oid, BlobPermissions.READ, expiry
+                self.layout.locate(oid, self.key_exists), BlobPermissions.READ, expiry
             ),
             expires_at=expiry.isoformat()
         )
 
     def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
-        expiry = datetime.utcnow().replace(microsecond=0, tzinfo=timezone.utc) + timedelta(hours=1)
+        expiry = self.batch_expiry()
 
         return BatchResponse.ObjectLfs.Action(
             href=self.generate_blob_shared_access_signature_url(
-                oid, BlobPermissions.WRITE, expiry
+                self.layout.key(oid), BlobPermissions.WRITE, expiry
             ),
             header={
                 'x-ms-blob-type': 'BlockBlob'
@@ -61,35 +231,139 @@ class BlobLargeFileStorage(LargeFileStorage):
             expires_at=expiry.isoformat()
         )
 
-    def generate_blob_shared_access_signature_url(self, oid, permission, expiry):
-        sas = self.client.generate_blob_shared_access_signature(
-            self.storage_container_name, oid, permission, expiry
+    def batch_expiry(self) -> datetime:
+        # objects of a batch are signed within the same second, so they share one expiry and its signed fields
+        now = int(self.clock())
+        second, expiry = self.expiry
+        if second != now:
+            expiry = datetime.fromtimestamp(now, timezone.utc) + timedelta(hours=1)
+            self.expiry = (now, expiry)
+        return expiry
+
+    def generate_blob_shared_access_signature_url(self, key, permission, expiry):
+        if self.local_sas:
+            if self.sas_builder is None:
+                self.sas_builder = SharedAccessSignatureBuilder(
+                    self.storage_account_name, self.storage_account_primary_key, self.storage_container_name
+                )
+            sas = self.sas_builder.generate(key, str(permission), expiry)
+        else:
+            sas = self.client.generate_blob_shared_access_signature(
+                self.storage_container_name, key, permission, expiry
+            )
+
+        return f'https://{self.storage_account_name}.blob.core.windows.net/{self.storage_container_name}/{key}?{sas}'
+
+
+class Factory:
+    @staticmethod
+    def create_large_file_storage():
+        lfs = BlobLargeFileStorage(
+            layout=Factory.create_key_layout(),
+            local_sas=os.getenv('AZURE_LOCAL_SAS', 'true').lower() == 'true',
+            head_threshold=int(os.getenv('AZURE_HEAD_THRESHOLD', '100')),
+            max_workers=int(os.getenv('AZURE_MAX_CONNECTIONS', '16'))
         )
+        if existence_cache.enabled:
+            lfs = CachingLargeFileStorage(lfs, existence_cache)
+        if presign_cache.enabled:
+            lfs = PresignCachingLargeFileStorage(lfs, presign_cache, expires_in=3600)
+        return lfs
 
-        return f'https://{self.storage_account_name}.blob.core.windows.net/{self.storage_container_name}/{oid}?{sas}'
+    @staticmethod
+    def large_file_storage():
+        return registry.get('large_file_storage', Factory.create_large_file_storage)
 
+    @staticmethod
+    def create_oid_index(lfs: LargeFileStorage):
+        if os.getenv('OID_INDEX', 'false').lower() != 'true':
+            return None
 
-class KeyInsensitiveDict(dict):
-    def __getitem__(self, key):
-        return dict.__getitem__(self, key.lower())
+        key = os.getenv('OID_INDEX_KEY', '.lfs/oids.bloom')
+        return OidIndex(
+            lambda: lfs.read_object(key),
+            lambda data, etag: lfs.write_object(key, data, etag),
+            scan=lfs.iter_oids,
+            capacity=int(os.getenv('OID_INDEX_CAPACITY', '1000000')),
+            error_rate=float(os.getenv('OID_INDEX_ERROR_RATE', '0.01')),
+            max_age=float(os.getenv('OID_INDEX_MAX_AGE', '60'))
+        )
 
-    def get(self, key, *args, **kwargs):
-        return dict.get(self, key.lower(), *args, **kwargs)
+    @staticmethod
+    def oid_index():
+        lfs = Factory.large_file_storage()
+        return registry.get('oid_index', lambda: Factory.create_oid_index(lfs))
 
+    @staticmethod
+    def reset():
+        registry.reset()
+        existence_cache.clear()
+        presign_cache.clear()
+
+    @staticmethod
+    def create_key_layout():
+        return KeyLayout.create(
+            os.getenv('KEY_LAYOUT', 'flat'),
+            prefix=os.getenv('KEY_PREFIX', ''),
+            legacy=KeyLayout() if os.getenv('KEY_LEGACY_FALLBACK', 'true').lower() == 'true' else None
+        )
 
-class Factory:
     @staticmethod
-    def create_batch_facade():
-        return BatchFacade(BlobLargeFileStorage())
+    def create_instrumentation():
+        if os.getenv('LOG_METRICS', 'false').lower() == 'true':
+            return LoggingInstrumentation(logger)
+        if os.getenv('LOG_SUMMARY', 'true').lower() == 'true':
+            return SummaryInstrumentation(logger)
+        return Instrumentation()
+
+    @staticmethod
+    def create_batch_facade(endpoint: str = None):
+        return BatchFacade(
+            Factory.large_file_storage(),
+            executor=shared_executor(int(os.getenv('BATCH_MAX_WORKERS', '0'))),
+            max_concurrency=int(os.getenv('BATCH_MAX_CONCURRENCY', '0')) or None,
+            instrumentation=Factory.create_instrumentation(),
+            skip_existing_uploads=os.getenv('SKIP_EXISTING_UPLOADS', 'true').lower() == 'true',
+            verify_upload_size=os.getenv('VERIFY_UPLOAD_SIZE', 'false').lower() == 'true',
+            verify_endpoint=Factory.create_verify_endpoint(endpoint),
+            part_size=int(os.getenv('MULTIPART_PART_SIZE', '0')) or None,
+            oid_index=Factory.oid_index()
+        )
+
+    @staticmethod
+    def create_response_compressor():
+        if os.getenv('COMPRESS_RESPONSES', 'true').lower() != 'true':
+            return None
+        return ResponseCompressor(min_size=int(os.getenv('COMPRESS_MIN_SIZE', '1024')))
+
+    @staticmethod
+    def create_verify_endpoint(endpoint: str = None):
+        if os.getenv('VERIFY_UPLOADS', 'true').lower() != 'true':
+            return None
+        return os.getenv('LFS_ENDPOINT', endpoint)
+
+    @staticmethod
+    def create_verify_facade():
+        return VerifyFacade(
+            Factory.large_file_storage(),
+            instrumentation=Factory.create_instrumentation(),
+            oid_index=Factory.oid_index()
+        )
 
 
 def process(request: func.HttpRequest, context: func.Context) -> func.HttpResponse:
+    start = time.perf_counter()
+    facade, status = None, 500
     try:
-        facade = Factory.create_batch_facade()
+        base, api, path = re.split('(api)', request.url, 1)
+        if path == '/objects/verify':
+            facade = Factory.create_verify_facade()
+        else:
+            facade = Factory.create_batch_facade(f'{base}{api}/')
 
         response = facade.process(
             HttpRequest(
-                path=re.split('(api)', request.url)[2],
+                path=path,
                 method=request.method,
                 headers=KeyInsensitiveDict(request.headers),
                 parameters=KeyInsensitiveDict(request.params),
@@ -97,15 +371,26 @@ def process(request: func.HttpRequest, context: func.Context) -> func.HttpRespon
             )
         )
 
+        with facade.instrumentation.measure('serialize'):
+            body = json.dumps(dataclass_as_dict(response.body)).encode()
+
+        headers = response.headers
+        compressor = Factory.create_response_compressor()
+        if compressor is not None:
+            with facade.instrumentation.measure('compress'):
+                body, encoding = compressor.compress(body, request.headers.get('Accept-Encoding'))
+            if encoding is not None:
+                headers = {**headers, **ResponseCompressor.headers(encoding)}
+
+        status = response.status_code
         return func.HttpResponse(
             status_code=response.status_code,
-            headers=response.headers,
-            body=json.dumps(
-                dataclass_as_dict(response.body)
-            )
+            headers=headers,
+            body=body
         )
 
     except HttpError as e:
+        status = e.code
         return func.HttpResponse(
             status_code=e.code,
             mimetype='application/json',
@@ -130,9 +415,19 @@ def process(request: func.HttpRequest, context: func.Context) -> func.HttpRespon
             )
         )
 
+    finally:
+        if facade is not None:
+            facade.instrumentation.annotate(
+                status=status,
+                duration=round(time.perf_counter() - start, 6),
+                request_id=context.invocation_id
+            )
+            facade.instrumentation.flush()
+
 
 def main(req: func.HttpRequest, context: func.Context) -> func.HttpResponse:
-    logger.info('azure.HttpRequest: %s' % vars(req))
+    level = payload_log_level(float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0')))
+    logger.log(level, 'azure.HttpRequest: %s', vars(req))
     res = process(req, context)
-    logger.info('azure.HttpResponse: %s' % vars(res))
+    logger.log(level, 'azure.HttpResponse: %s', vars(res))
     return res
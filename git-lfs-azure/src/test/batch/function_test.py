@@ -1,14 +1,45 @@
+import base64
+import gzip
+import hashlib
+import json
 import unittest
-from datetime import datetime
+from datetime import datetime, timezone
 from unittest import mock
 
-from azure.storage.blob import BlobPermissions
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.blob import BlobPermissions, blockblobservice
+from azure.storage.blob.models import Blob
 
 from batch import function
 
 RFC3339_REGEX = r'^([0-9]+)-(0[1-9]|1[012])-(0[1-9]|[12][0-9]|3[01])[Tt]([01][0-9]|2[0-3]):([0-5][0-9]):([0-5][0-9]|60)(\.[0-9]+)?(([Zz])|([\+|\-]([01][0-9]|2[0-3]):[0-5][0-9]))$'
 
 
+class FakeBlobService:
+
+    def __init__(self, blobs, page_size=5000):
+        self.blobs = dict(sorted(blobs.items()))
+        self.page_size = page_size
+        self.calls = []
+
+    def get_blob_properties(self, container_name, blob_name):
+        self.calls.append('get_blob_properties')
+        if blob_name not in self.blobs:
+            raise AzureMissingResourceHttpError('The specified blob does not exist.', 404)
+        return self.blob(blob_name)
+
+    def list_blobs(self, container_name, prefix=None):
+        matched = [name for name in self.blobs if name.startswith(prefix or '')]
+        for i in range(0, max(len(matched), 1), self.page_size):
+            self.calls.append('list_blobs')
+            yield from (self.blob(name) for name in matched[i:i + self.page_size])
+
+    def blob(self, name):
+        blob = Blob(name)
+        blob.properties.content_length = self.blobs[name]
+        return blob
+
+
 class BlobLargeFileStorageTestCase(unittest.TestCase):
 
     @mock.patch('azure.storage.blob.blockblobservice.BlockBlobService')
@@ -39,6 +70,85 @@ class BlobLargeFileStorageTestCase(unittest.TestCase):
         self.assertFalse(actual)
         self.mock_client.exists.assert_called_once_with('StorageContainerName', 'happyface.jpg')
 
+    def test_sharded_layout_legacy_fallback(self):
+        from core import KeyLayout, ShardedKeyLayout
+
+        self.lfs.layout = ShardedKeyLayout(legacy=KeyLayout())
+        self.mock_client.exists.side_effect = lambda container, key: key == 'happyface.jpg'
+
+        actual = self.lfs.exists('happyface.jpg')
+
+        self.assertTrue(actual)
+        self.assertEqual(
+            self.mock_client.exists.call_args_list,
+            [
+                mock.call('StorageContainerName', 'ha/pp/happyface.jpg'),
+                mock.call('StorageContainerName', 'happyface.jpg')
+            ]
+        )
+
+    def test_exists_many_sweeps(self):
+        oids = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(6000)]
+        self.lfs.client = FakeBlobService({oid: i for i, oid in enumerate(oids[:4000])}, page_size=10)
+
+        actual = self.lfs.exists_many(oids[::2] + oids[4000:])
+
+        self.assertEqual(actual, set(oids[:4000:2]))
+        self.assertEqual(set(self.lfs.client.calls), {'list_blobs'})
+        self.assertLessEqual(len(self.lfs.client.calls), 4000 // 10 + 256)
+
+    def test_exists_many_head(self):
+        oids = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(200)]
+        self.lfs.client = FakeBlobService({oid: i for i, oid in enumerate(oids[:50])})
+
+        self.assertEqual(self.lfs.exists_many(oids[:40] + oids[50:60]), set(oids[:40]))
+        self.assertEqual(self.lfs.client.calls, ['get_blob_properties'] * 50)
+
+        # above the threshold, but too sparse to share sweep prefixes
+        self.lfs.head_threshold = 10
+        self.lfs.client.calls.clear()
+        self.assertEqual(self.lfs.exists_many(oids[:200:10]), set(oids[:50:10]))
+        self.assertEqual(self.lfs.client.calls, ['get_blob_properties'] * 20)
+
+    def test_sizes_many_legacy_fallback(self):
+        from core import KeyLayout, ShardedKeyLayout
+
+        oids = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(1000)]
+        self.lfs.layout = ShardedKeyLayout(legacy=KeyLayout())
+        self.lfs.client = FakeBlobService({**{self.lfs.layout.key(oid): 1 for oid in oids[:300]},
+                                           **{oid: 2 for oid in oids[300:600]}})
+
+        actual = self.lfs.sizes_many(oids)
+
+        self.assertEqual(actual, {**dict.fromkeys(oids[:300], 1), **dict.fromkeys(oids[300:600], 2)})
+        self.assertEqual(set(self.lfs.client.calls), {'list_blobs'})
+        calls = len(self.lfs.client.calls)
+        self.lfs.generate_blob_shared_access_signature_url = mock.MagicMock()
+        self.lfs.prepare_download(oids[400], 2)
+        self.assertEqual(self.lfs.generate_blob_shared_access_signature_url.call_args[0][0], oids[400])
+        self.assertEqual(len(self.lfs.client.calls), calls)
+
+    def test_oid_index_storage(self):
+        self.mock_client.get_blob_to_bytes.side_effect = AzureMissingResourceHttpError('Not found', 404)
+        self.assertEqual(self.lfs.read_object('.lfs/oids.bloom'), (None, None))
+
+        self.mock_client.get_blob_to_bytes.side_effect = None
+        self.mock_client.get_blob_to_bytes.return_value.content = b'foo'
+        self.mock_client.get_blob_to_bytes.return_value.properties.etag = '"0x1"'
+        self.assertEqual(self.lfs.read_object('.lfs/oids.bloom'), (b'foo', '"0x1"'))
+
+        self.assertTrue(self.lfs.write_object('.lfs/oids.bloom', b'foo', None))
+        self.mock_client.create_blob_from_bytes.assert_called_with(
+            'StorageContainerName', '.lfs/oids.bloom', b'foo', if_none_match='*')
+        self.mock_client.create_blob_from_bytes.side_effect = AzureHttpError('Precondition failed', 412)
+        self.assertFalse(self.lfs.write_object('.lfs/oids.bloom', b'foo', '"0x1"'))
+        self.mock_client.create_blob_from_bytes.assert_called_with(
+            'StorageContainerName', '.lfs/oids.bloom', b'foo', if_match='"0x1"')
+
+        oid = hashlib.sha256(b'foo').hexdigest()
+        self.mock_client.list_blob_names.return_value = iter([f'{oid[:2]}/{oid[2:4]}/{oid}', '.lfs/oids.bloom'])
+        self.assertEqual(list(self.lfs.iter_oids()), [oid])
+
     def test_generate_blob_shared_access_signature_url(self):
         self.mock_client.generate_blob_shared_access_signature.return_value = 'ZA1XSW2EDC'
         expiry = datetime.fromtimestamp(1590558507)
@@ -52,6 +162,37 @@ class BlobLargeFileStorageTestCase(unittest.TestCase):
         self.mock_client.generate_blob_shared_access_signature.assert_called_once_with(
             'StorageContainerName', 'happyface.jpg', BlobPermissions.WRITE, expiry)
 
+    def test_generate_blob_shared_access_signature_url_local(self):
+        account_key = base64.b64encode(b'account-key' * 6).decode()
+        self.lfs.storage_account_primary_key = account_key
+        self.lfs.local_sas = True
+        client = blockblobservice.BlockBlobService(account_name='StorageAccountName', account_key=account_key)
+
+        for key in ('happyface.jpg', 'ha/pp/happyface.jpg', 'prefix/a b+c.jpg'):
+            for permission in (BlobPermissions.READ, BlobPermissions.WRITE):
+                for expiry in (datetime.fromtimestamp(1590558507, timezone.utc), self.lfs.batch_expiry()):
+                    sas = client.generate_blob_shared_access_signature(
+                        'StorageContainerName', key, permission, expiry
+                    )
+
+                    actual = self.lfs.generate_blob_shared_access_signature_url(key, permission, expiry)
+
+                    self.assertEqual(
+                        actual, f'https://StorageAccountName.blob.core.windows.net/StorageContainerName/{key}?{sas}'
+                    )
+
+    def test_batch_expiry(self):
+        now = 1590558507.5
+        self.lfs.clock = lambda: now
+
+        actual = self.lfs.batch_expiry()
+
+        self.assertEqual(actual, datetime(2020, 5, 27, 6, 48, 27, tzinfo=timezone.utc))
+        now += 0.4
+        self.assertIs(self.lfs.batch_expiry(), actual)
+        now += 1
+        self.assertEqual(self.lfs.batch_expiry(), datetime(2020, 5, 27, 6, 48, 28, tzinfo=timezone.utc))
+
     def test_prepare_download(self):
         with mock.patch('batch.function.BlobLargeFileStorage.generate_blob_shared_access_signature_url') as mock_method:
             mock_method.return_value = 'https://example.com'
@@ -74,31 +215,6 @@ class BlobLargeFileStorageTestCase(unittest.TestCase):
             self.assertEqual(actual.header.get('x-ms-blob-type'), 'BlockBlob')
 
 
-class KeyInsensitiveDictTestCase(unittest.TestCase):
-
-    def setUp(self) -> None:
-        self.dictionary = function.KeyInsensitiveDict(
-            {
-                'foo': 'bar'
-            }
-        )
-
-    def test_getitem(self):
-        actual = self.dictionary['Foo']
-
-        self.assertEqual(actual, 'bar')
-
-    def test_get(self):
-        actual = self.dictionary.get('Foo')
-
-        self.assertEqual(actual, 'bar')
-
-    def test_get_missing_value(self):
-        actual = self.dictionary.get('baz')
-
-        self.assertIsNone(actual)
-
-
 class FunctionTestCase(unittest.TestCase):
 
     def setUp(self) -> None:
@@ -153,3 +269,31 @@ class FunctionTestCase(unittest.TestCase):
             self.assertIsNotNone(actual)
             self.assertEqual(actual.status_code, 200)
             self.assertEqual(actual.get_body(), b'{"transfer": "foo", "objects": []}')
+
+    def test_process_compressed(self):
+        from core import HttpResponse, BatchResponse
+
+        self.mock_request.headers = {'Accept-Encoding': 'gzip, deflate'}
+        objects = [BatchResponse.ObjectLfs(f'{i:064x}', i) for i in range(100)]
+        with mock.patch('batch.function.Factory.create_batch_facade') as mock_factory:
+            mock_factory.return_value = self.mock_facade
+            self.mock_facade.process.return_value = HttpResponse(BatchResponse('basic', objects))
+
+            actual = function.process(self.mock_request, self.mock_context)
+
+            self.assertEqual(actual.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(len(json.loads(gzip.decompress(actual.get_body()))['objects']), 100)
+
+    def test_process_verify(self):
+        from core import HttpResponse, VerifyRequest
+
+        self.mock_request.url = 'https://foo.com/api/objects/verify'
+        with mock.patch('batch.function.Factory.create_verify_facade') as mock_factory:
+            mock_factory.return_value = self.mock_facade
+            self.mock_facade.process.return_value = HttpResponse(VerifyRequest('foo', 123))
+
+            actual = function.process(self.mock_request, self.mock_context)
+
+            self.assertEqual(actual.status_code, 200)
+            self.assertEqual(actual.get_body(), b'{"oid": "foo", "size": 123}')
+            self.assertEqual(self.mock_facade.process.call_args[0][0].path, '/objects/verify')
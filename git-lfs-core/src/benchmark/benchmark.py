@@ -0,0 +1,182 @@
+import argparse
+import hashlib
+import json
+import sys
+import time
+import tracemalloc
+from typing import Dict, Iterable, List, Set, Any, Optional
+
+from core import *
+
+__all__ = (
+    'InMemoryLargeFileStorage',
+    'Benchmark'
+)
+
+
+class InMemoryLargeFileStorage(LargeFileStorage):
+
+    def __init__(self, objects: Dict[str, int] = None, latency: float = 0.0):
+        self.objects = objects if objects is not None else {}
+        self.latency = latency
+
+    def exists(self, oid: str) -> bool:
+        self.wait()
+        return oid in self.objects
+
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        self.wait()
+        return {oid for oid in oids if oid in self.objects}
+
+    def size(self, oid: str) -> Optional[int]:
+        self.wait()
+        return self.objects.get(oid)
+
+    def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        self.wait()
+        return BatchResponse.ObjectLfs.Action(
+            href=f'https://storage.example.com/{oid}?operation=download'
+        )
+
+    def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        self.wait()
+        return BatchResponse.ObjectLfs.Action(
+            href=f'https://storage.example.com/{oid}?operation=upload'
+        )
+
+    def wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class Benchmark:
+
+    def __init__(self, latency: float = 0.0, workers: int = 0, max_concurrency: int = None,
+                 streaming: bool = False, repeat: int = 5):
+        self.latency = latency
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.streaming = streaming
+        self.repeat = repeat
+
+    def run(self, operation: str, size: int) -> Dict[str, Any]:
+        oids = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(size)]
+        stored = {oid: i for i, oid in enumerate(oids)} if operation == 'download' else {}
+        lfs = InMemoryLargeFileStorage(stored, self.latency)
+        facade = BatchFacade(
+            lfs,
+            executor=shared_executor(self.workers),
+            max_concurrency=self.max_concurrency,
+            streaming=self.streaming
+        )
+        body = json.dumps({
+            'operation': operation,
+            'transfers': ['basic'],
+            'objects': [{'oid': oid, 'size': i} for i, oid in enumerate(oids)]
+        })
+
+        latencies = sorted(self.call(facade, body) for _ in range(self.repeat))
+
+        tracemalloc.start()
+        self.call(facade, body)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        mean = sum(latencies) / len(latencies)
+        return {
+            'operation': operation,
+            'size': size,
+            'repeat': self.repeat,
+            'latency': self.latency,
+            'workers': self.workers,
+            'streaming': self.streaming,
+            'throughput': size / mean if mean > 0 else None,
+            'p50': self.percentile(latencies, 50),
+            'p99': self.percentile(latencies, 99),
+            'peak_memory': peak_memory
+        }
+
+    @staticmethod
+    def call(facade: BatchFacade, body: str) -> float:
+        start = time.perf_counter()
+        response = facade.process(
+            HttpRequest(
+                path='/objects/batch',
+                method='POST',
+                headers={
+                    'Accept': 'application/vnd.git-lfs+json'
+                },
+                body=body
+            )
+        )
+        for _ in response.body.iter_json():
+            pass
+        return time.perf_counter() - start
+
+    @staticmethod
+    def percentile(values: List[float], p: int) -> float:
+        index = max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))
+        return values[index]
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float) -> List[str]:
+    def key(r):
+        return r['operation'], r['size'], r['latency'], r['workers'], r['streaming']
+
+    expected = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = expected.get(key(result))
+        if base is None or not base['throughput'] or not result['throughput']:
+            continue
+
+        if result['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append(
+                f'{result["operation"]} size={result["size"]}: throughput '
+                f'{result["throughput"]:.0f}/s < baseline {base["throughput"]:.0f}/s'
+            )
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Git LFS: Batch API benchmark', add_help=False)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 10000, 100000],
+                        help="The number of objects in a batch request.")
+    parser.add_argument('--operations', type=str, nargs='+', default=['download', 'upload'],
+                        choices=['download', 'upload'], help="The batch operations to benchmark.")
+    parser.add_argument('--repeat', type=int, default=5, help="The number of measured calls per batch size.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds injected into each storage call.")
+    parser.add_argument('--max-workers', type=int, default=0, help="The number of threads processing objects.")
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help="The maximum number of objects of a single batch processed concurrently.")
+    parser.add_argument('--streaming', action='store_true', help="Stream batch request and response bodies.")
+    parser.add_argument('--baseline', type=str, default=None, help="Results file of a previous run to compare.")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Tolerated relative throughput drop.")
+    parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Print this message')
+    args = parser.parse_args()
+
+    benchmark = Benchmark(
+        latency=args.latency,
+        workers=args.max_workers,
+        max_concurrency=args.max_concurrency,
+        streaming=args.streaming,
+        repeat=args.repeat
+    )
+
+    results = []
+    for operation in args.operations:
+        for size in args.sizes:
+            result = benchmark.run(operation, size)
+            results.append(result)
+            print(json.dumps(result), flush=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+
+        sys.exit(1 if regressions else 0)
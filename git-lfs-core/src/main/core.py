@@ -1,9 +1,34 @@
 from __future__ import annotations
 
+import asyncio
+import codecs
+import itertools
 import json
+import logging
+import math
+import random
+import re
+import struct
+import threading
+import time
+import zlib
 from abc import ABC
-from dataclasses import dataclass, field, asdict
-from typing import List, Dict, Any
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field, fields, replace
+from datetime import datetime, timezone
+from types import GeneratorType
+from typing import List, Dict, Any, Iterable, Iterator, Set, Callable, Optional, Tuple, Union, Container
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 __all__ = (
     'HttpRequest',
@@ -12,20 +37,59 @@ __all__ = (
     'BatchRequest',
     'BatchResponse',
     'BatchError',
+    'MultipartUpload',
+    'BatchRequestReader',
+    'VerifyRequest',
+    'Instrumentation',
+    'Measurement',
+    'SummaryInstrumentation',
+    'LoggingInstrumentation',
+    'LazyJson',
+    'KeyInsensitiveDict',
+    'ResponseCompressor',
+    'KeyLayout',
+    'ShardedKeyLayout',
+    'PrefixedKeyLayout',
     'LargeFileStorage',
+    'AsyncLargeFileStorage',
+    'ThreadOffloadLargeFileStorage',
+    'LargeFileStorageWrapper',
+    'ExistenceCache',
+    'CachingLargeFileStorage',
+    'BloomFilter',
+    'OidIndex',
+    'oids_of',
+    'PresignCache',
+    'PresignCachingLargeFileStorage',
+    'InstrumentedLargeFileStorage',
     'BatchFacade',
+    'AsyncBatchFacade',
+    'VerifyFacade',
+
+    'Registry',
 
-    'dataclass_as_dict'
+    'dataclass_as_dict',
+    'payload_log_level',
+    'shared_executor'
 )
 
 
+def dataclass_slots(cls):
+    names = tuple(f.name for f in fields(cls))
+    namespace = {k: v for k, v in cls.__dict__.items() if k not in names + ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    slotted = type(cls)(cls.__name__, cls.__bases__, namespace)
+    slotted.__qualname__ = cls.__qualname__
+    return slotted
+
+
 @dataclass
 class HttpRequest:
     path: str
     method: str
     headers: Dict[str, str] = field(default_factory=dict)
     parameters: Dict[str, str] = field(default_factory=dict)
-    body: str = None
+    body: Union[str, Iterable[Union[str, bytes]]] = None
 
 
 @dataclass
@@ -55,22 +119,28 @@ class BatchRequest:
         size: int
 
     operation: str
-    objects: List[ObjectLfs]
+    objects: Iterable[ObjectLfs]
     transfers: List[str] = field(default_factory=lambda: ['basic'])
     ref: RefSpec = None
 
 
+@dataclass_slots
 @dataclass
 class BatchResponse:
+    @dataclass_slots
     @dataclass
     class ObjectLfs:
+        @dataclass_slots
         @dataclass
         class Action:
             href: str
             header: Dict[str, str] = field(default_factory=dict)
             expires_in: int = None
             expires_at: str = None
+            pos: int = None
+            size: int = None
 
+        @dataclass_slots
         @dataclass
         class Error:
             code: int
@@ -79,15 +149,33 @@ class BatchResponse:
         oid: str
         size: int
         authenticated: bool = None
-        actions: Dict[str, Action] = None
+        actions: Dict[str, Union[Action, List[Action]]] = None
         error: Error = None
 
     transfer: str
-    objects: List[ObjectLfs]
+    objects: Iterable[ObjectLfs]
 
     def as_dict(self) -> Dict[str, Any]:
         return dataclass_as_dict(self)
 
+    def as_json(self) -> str:
+        return json.dumps(self.as_dict())
+
+    def iter_json(self, chunk_size: int = 16 * 1024) -> Iterator[str]:
+        yield '{"transfer": %s, "objects": [' % json.dumps(self.transfer)
+
+        chunk, length = [], 0
+        for i, obj in enumerate(self.objects):
+            item = json.dumps(None if obj is None else dataclass_as_dict(obj))
+            chunk.append(item if i == 0 else ', ' + item)
+            length += len(item)
+            if length >= chunk_size:
+                yield ''.join(chunk)
+                chunk, length = [], 0
+
+        chunk.append(']}')
+        yield ''.join(chunk)
+
 
 class BatchError(Exception):
 
@@ -97,63 +185,1077 @@ class BatchError(Exception):
         self.message = message
 
 
+@dataclass
+class MultipartUpload:
+    parts: List[BatchResponse.ObjectLfs.Action]
+    commit: BatchResponse.ObjectLfs.Action = None
+    abort: BatchResponse.ObjectLfs.Action = None
+
+
+@dataclass
+class VerifyRequest:
+    oid: str
+    size: int
+
+
+class BatchRequestReader:
+
+    def __init__(self, body: Union[str, Iterable[Union[str, bytes]]]):
+        self.chunks = iter((body,) if isinstance(body, (str, bytes)) else body)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self) -> BatchRequest:
+        header = {}
+
+        self.expect('{')
+        while self.peek() != '}':
+            if header:
+                self.expect(',')
+
+            key = self.value()
+            self.expect(':')
+
+            if key != 'objects':
+                header[key] = self.value()
+                continue
+
+            if 'operation' in header:
+                request = self.create_request(header, objects=None)
+                request.objects = self.iter_objects(request, header)
+                return request
+
+            header['objects'] = list(self.iter_objects(None, header))
+
+        self.expect('}')
+        return self.create_request(header, objects=header['objects'])
+
+    def iter_objects(self, request: Optional[BatchRequest], header: Dict[str, Any]) -> Iterator[BatchRequest.ObjectLfs]:
+        self.expect('[')
+        if self.peek() != ']':
+            while True:
+                obj = self.value()
+                yield BatchRequest.ObjectLfs(obj['oid'], obj['size'])
+
+                if self.peek() != ',':
+                    break
+                self.expect(',')
+
+        self.expect(']')
+        if request is None:
+            return
+
+        while self.peek() == ',':
+            self.expect(',')
+            key = self.value()
+            self.expect(':')
+            header[key] = self.value()
+
+        self.expect('}')
+        trailer = self.create_request(header, objects=None)
+        request.transfers = trailer.transfers
+        request.ref = trailer.ref
+
+    @staticmethod
+    def create_request(header: Dict[str, Any], objects: Optional[Iterable[BatchRequest.ObjectLfs]]) -> BatchRequest:
+        return BatchRequest(
+            operation=header['operation'],
+            transfers=header.get('transfers', ['basic', ]),
+            ref=BatchRequest.RefSpec(header['ref']['name']) if header.get('ref') else None,
+            objects=objects
+        )
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def expect(self, token: str) -> None:
+        if self.peek() != token:
+            raise json.JSONDecodeError(f'Expecting {token!r} delimiter', self.buffer, self.pos)
+        self.pos += 1
+
+    def peek(self) -> Optional[str]:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self.fill():
+                return None
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8.decode(chunk)
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return True
+
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(b'', final=True)
+        self.pos = 0
+        self.eof = True
+        return False
+
+
+class Instrumentation:
+
+    def measure(self, phase: str, count: int = 0) -> Measurement:
+        if type(self).record is Instrumentation.record:
+            return _NOOP_MEASUREMENT
+
+        return Measurement(self, phase, count)
+
+    def record(self, phase: str, duration: float, count: int = 0, errors: int = 0) -> None:
+        pass
+
+    def annotate(self, **fields) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+
+class Measurement:
+
+    def __init__(self, instrumentation: Instrumentation, phase: str, count: int = 0):
+        self.instrumentation = instrumentation
+        self.phase = phase
+        self.count = count
+        self.errors = 0
+        self.start = None
+
+    def __enter__(self) -> Measurement:
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        duration = time.perf_counter() - self.start
+        self.instrumentation.record(
+            self.phase, duration, self.count, self.errors + (1 if exc_type is not None else 0)
+        )
+
+
+class _NoopMeasurement(Measurement):
+
+    def __init__(self):
+        super().__init__(Instrumentation(), '')
+
+    def __enter__(self) -> Measurement:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+
+_NOOP_MEASUREMENT = _NoopMeasurement()
+
+
+class SummaryInstrumentation(Instrumentation):
+
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO):
+        self.logger = logger or logging.getLogger()
+        self.level = level
+        self.fields: Dict[str, Any] = {}
+
+    def annotate(self, **fields) -> None:
+        self.fields.update(fields)
+
+    def flush(self) -> None:
+        fields, self.fields = self.fields, {}
+        if fields:
+            self.logger.log(self.level, 'Summary: %s', LazyJson(fields))
+
+
+class LoggingInstrumentation(SummaryInstrumentation):
+
+    def __init__(self, logger: logging.Logger = None, level: int = logging.INFO):
+        super().__init__(logger, level)
+        self.metrics: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, phase: str, duration: float, count: int = 0, errors: int = 0) -> None:
+        with self.lock:
+            metric = self.metrics.get(phase)
+            if metric is None:
+                metric = self.metrics[phase] = {'calls': 0, 'duration': 0.0, 'count': 0, 'errors': 0}
+
+            metric['calls'] += 1
+            metric['duration'] += duration
+            metric['count'] += count
+            metric['errors'] += errors
+
+    def flush(self) -> None:
+        super().flush()
+        with self.lock:
+            metrics, self.metrics = self.metrics, {}
+
+        if metrics:
+            self.logger.log(self.level, 'Metrics: %s', json.dumps(metrics))
+
+
+class LazyJson:
+    __slots__ = ('obj',)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj, default=str)
+
+
+class KeyInsensitiveDict(dict):
+    def __init__(self, items: Union[Dict[str, Any], Iterable[Tuple[str, Any]]] = ()):
+        super().__init__((k.lower(), v) for k, v in dict(items).items())
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def get(self, key, *args, **kwargs):
+        return dict.get(self, key.lower(), *args, **kwargs)
+
+
+def payload_log_level(sample_rate: float, sample: Callable[[], float] = random.random) -> int:
+    # payloads are emitted at DEBUG, or at INFO for a sampled share of the requests
+    if sample_rate > 0 and sample() < sample_rate:
+        return logging.INFO
+    return logging.DEBUG
+
+
+class _BrotliCompressObj:
+
+    def __init__(self, quality: int):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ResponseCompressor:
+    preferences = ('zstd', 'br', 'gzip')
+
+    def __init__(self, min_size: int = 1024, encodings: Iterable[str] = None):
+        self.min_size = min_size
+        self.encodings = tuple(
+            encoding for encoding in (encodings or self.preferences) if encoding in self.available()
+        )
+
+    @staticmethod
+    def available() -> Set[str]:
+        encodings = {'gzip'}
+        if brotli is not None:
+            encodings.add('br')
+        if zstandard is not None:
+            encodings.add('zstd')
+        return encodings
+
+    def negotiate(self, accept_encoding: Optional[str]) -> Optional[str]:
+        accepted = {}
+        for item in (accept_encoding or '').split(','):
+            name, _, params = item.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[name.strip().lower()] = quality
+
+        default = accepted.get('*', 0.0)
+        return next((encoding for encoding in self.encodings if accepted.get(encoding, default) > 0), None)
+
+    def compress(self, body: bytes, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        if len(body) < self.min_size:
+            return body, None
+
+        encoding = self.negotiate(accept_encoding)
+        if encoding is None:
+            return body, None
+
+        compressor = self.compressobj(encoding)
+        return compressor.compress(body) + compressor.flush(), encoding
+
+    def compress_iter(self, chunks: Iterable[Union[str, bytes]], encoding: str) -> Iterator[bytes]:
+        compressor = self.compressobj(encoding)
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+
+        yield compressor.flush()
+
+    @staticmethod
+    def compressobj(encoding: str):
+        # fast levels: signatures dominate what is left after the repeated URL prefixes, so
+        # higher levels double the time for a few percent smaller batch responses
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=3).compressobj()
+        if encoding == 'br':
+            return _BrotliCompressObj(quality=4)
+        return zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    @staticmethod
+    def headers(encoding: str) -> Dict[str, str]:
+        return {
+            'Content-Encoding': encoding,
+            'Vary': 'Accept-Encoding'
+        }
+
+
+_EMPTY_VALUES = (u'', None, {})
+_OID_PATTERN = re.compile(r'[0-9a-f]{64}')
+_dataclass_field_names: Dict[type, Tuple[str, ...]] = {}
+
+
 def dataclass_as_dict(obj):
+    def scrub_dataclass(o):
+        names = _dataclass_field_names.get(type(o))
+        if names is None:
+            names = _dataclass_field_names.setdefault(type(o), tuple(f.name for f in fields(o)))
+
+        scrubbed_dict = {}
+        for k in names:
+            v = scrub(getattr(o, k))
+            if v not in _EMPTY_VALUES:
+                scrubbed_dict[k] = v
+        return scrubbed_dict
+
     def scrub_dict(d):
         scrubbed_dict = {}
         for k, v in d.items():
-            if isinstance(v, dict):
-                v = scrub_dict(v)
-            if isinstance(v, list):
-                v = scrub_list(v)
-            if v not in (u'', None, {}):
+            v = scrub(v)
+            if v not in _EMPTY_VALUES:
                 scrubbed_dict[k] = v
         return scrubbed_dict
 
-    def scrub_list(d):
-        scrubbed_list = []
-        for v in d:
-            if isinstance(v, dict):
-                v = scrub_dict(v)
-            scrubbed_list.append(v)
-        return scrubbed_list
+    def scrub(v):
+        if v is None or isinstance(v, (str, int, float)):
+            return v
+        if hasattr(type(v), '__dataclass_fields__'):
+            return scrub_dataclass(v)
+        if isinstance(v, dict):
+            return scrub_dict(v)
+        if isinstance(v, (list, GeneratorType)):
+            return [scrub(i) for i in v]
+        return v
+
+    return scrub_dataclass(obj)
+
+
+_executors: Dict[int, Executor] = {}
+_executors_lock = threading.Lock()
+
+
+def shared_executor(max_workers: int) -> Optional[Executor]:
+    if not max_workers or max_workers <= 0:
+        return None
+
+    with _executors_lock:
+        if max_workers not in _executors:
+            _executors[max_workers] = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix='git-lfs-batch'
+            )
+
+        return _executors[max_workers]
+
+
+class Registry:
+
+    def __init__(self):
+        self.instances: Dict[str, Any] = {}
+        # reentrant, so a factory may resolve the instances it depends on
+        self.lock = threading.RLock()
+
+    def get(self, name: str, factory: Callable[[], Any]) -> Any:
+        instance = self.instances.get(name)
+        if instance is not None:
+            return instance
+
+        with self.lock:
+            instance = self.instances.get(name)
+            if instance is None:
+                instance = self.instances[name] = factory()
+            return instance
+
+    def reset(self, name: str = None) -> None:
+        with self.lock:
+            if name is None:
+                self.instances.clear()
+            else:
+                self.instances.pop(name, None)
+
+
+class KeyLayout:
+
+    def __init__(self, legacy: KeyLayout = None, max_located: int = 10000):
+        self.legacy = legacy
+        self.max_located = max_located
+        self.located: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, oid: str) -> str:
+        return oid
+
+    def keys(self, oid: str) -> List[str]:
+        key = self.key(oid)
+        if self.legacy is None:
+            return [key]
+
+        legacy_key = self.legacy.key(oid)
+        return [key] if legacy_key == key else [key, legacy_key]
+
+    def locate(self, oid: str, exists: Callable[[str], bool]) -> str:
+        keys = self.keys(oid)
+        if len(keys) == 1:
+            return keys[0]
+
+        with self.lock:
+            key = self.located.get(oid)
+        if key is not None:
+            return key
+
+        return next((key for key in keys if exists(key)), keys[0])
+
+    def find(self, oid: str, exists: Callable[[str], bool]) -> Optional[str]:
+        keys = self.keys(oid)
+        return self.remember(oid, keys, next((key for key in keys if exists(key)), None))
+
+    def match(self, oid: str, found: Container[str]) -> Optional[str]:
+        keys = self.keys(oid)
+        return self.remember(oid, keys, next((key for key in keys if key in found), None))
+
+    def remember(self, oid: str, keys: List[str], key: Optional[str]) -> Optional[str]:
+        if len(keys) == 1:
+            return key
 
-    return scrub_dict(asdict(obj))
+        # a lookup that found the object records its key, so presigning the download needs no second request
+        with self.lock:
+            if key is None:
+                self.located.pop(oid, None)
+            else:
+                self.located[oid] = key
+                self.located.move_to_end(oid)
+                while len(self.located) > self.max_located:
+                    self.located.popitem(last=False)
+
+        return key
+
+    @staticmethod
+    def create(name: str, prefix: str = '', legacy: KeyLayout = None) -> KeyLayout:
+        if name == 'flat':
+            return KeyLayout(legacy)
+        if name == 'sharded':
+            return ShardedKeyLayout(legacy)
+        if name == 'prefixed':
+            return PrefixedKeyLayout(prefix, ShardedKeyLayout(), legacy)
+        raise ValueError(f'Unknown key layout: {name}')
+
+
+class ShardedKeyLayout(KeyLayout):
+
+    def key(self, oid: str) -> str:
+        return f'{oid[:2]}/{oid[2:4]}/{oid}'
+
+
+class PrefixedKeyLayout(KeyLayout):
+
+    def __init__(self, prefix: str, layout: KeyLayout = None, legacy: KeyLayout = None):
+        super().__init__(legacy)
+        self.prefix = prefix.strip('/')
+        self.layout = layout or KeyLayout()
+
+    def key(self, oid: str) -> str:
+        return f'{self.prefix}/{self.layout.key(oid)}'
 
 
 class LargeFileStorage(ABC):
     def exists(self, oid: str) -> bool:
         pass
 
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        return {oid for oid in oids if self.exists(oid)}
+
+    def size(self, oid: str) -> Optional[int]:
+        return None
+
+    def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        sizes = ((oid, self.size(oid)) for oid in oids)
+        return {oid: size for oid, size in sizes if size is not None}
+
     def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         pass
 
     def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         pass
 
+    def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        return MultipartUpload(parts=[replace(self.prepare_upload(oid, size), pos=0, size=size)])
+
+
+class AsyncLargeFileStorage(ABC):
+    async def exists(self, oid: str) -> bool:
+        pass
+
+    async def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        oids = list(oids)
+        found = await asyncio.gather(*(self.exists(oid) for oid in oids))
+        return {oid for oid, exists in zip(oids, found) if exists}
+
+    async def size(self, oid: str) -> Optional[int]:
+        return None
+
+    async def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        oids = list(oids)
+        sizes = await asyncio.gather(*(self.size(oid) for oid in oids))
+        return {oid: size for oid, size in zip(oids, sizes) if size is not None}
+
+    async def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        pass
+
+    async def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        pass
+
+    async def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        return MultipartUpload(parts=[replace(await self.prepare_upload(oid, size), pos=0, size=size)])
 
-class BatchFacade:
+
+class ThreadOffloadLargeFileStorage(AsyncLargeFileStorage):
+
+    def __init__(self, lfs: LargeFileStorage, executor: Executor = None):
+        self.lfs = lfs
+        self.executor = executor
+
+    async def exists(self, oid: str) -> bool:
+        return await self.offload(self.lfs.exists, oid)
+
+    async def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        return await self.offload(self.lfs.exists_many, list(oids))
+
+    async def size(self, oid: str) -> Optional[int]:
+        return await self.offload(self.lfs.size, oid)
+
+    async def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        return await self.offload(self.lfs.sizes_many, list(oids))
+
+    async def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        return await self.offload(self.lfs.prepare_download, oid, size)
+
+    async def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        return await self.offload(self.lfs.prepare_upload, oid, size)
+
+    async def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        return await self.offload(self.lfs.prepare_multipart_upload, oid, size, part_size)
+
+    async def offload(self, fn: Callable[..., Any], *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+
+class LargeFileStorageWrapper(LargeFileStorage):
 
     def __init__(self, lfs: LargeFileStorage):
         self.lfs = lfs
 
+    def exists(self, oid: str) -> bool:
+        return self.lfs.exists(oid)
+
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        return self.lfs.exists_many(oids)
+
+    def size(self, oid: str) -> Optional[int]:
+        return self.lfs.size(oid)
+
+    def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        return self.lfs.sizes_many(oids)
+
+    def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        return self.lfs.prepare_download(oid, size)
+
+    def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        return self.lfs.prepare_upload(oid, size)
+
+    def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        return self.lfs.prepare_multipart_upload(oid, size, part_size)
+
+    def __getattr__(self, name):
+        if name == 'lfs':
+            raise AttributeError(name)
+        return getattr(self.lfs, name)
+
+
+class ExistenceCache:
+
+    def __init__(self, max_size: int = 0, negative_ttl: float = 0, max_negative_size: int = 10000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.max_negative_size = max_negative_size
+        self.clock = clock
+        self.positive: OrderedDict[str, bool] = OrderedDict()
+        self.negative: OrderedDict[str, float] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 or (self.negative_ttl > 0 and self.max_negative_size > 0)
+
+    def get(self, oid: str) -> Optional[bool]:
+        with self.lock:
+            if oid in self.positive:
+                self.positive.move_to_end(oid)
+                self.hits += 1
+                return True
+
+            expires = self.negative.get(oid)
+            if expires is not None:
+                if expires > self.clock():
+                    self.hits += 1
+                    return False
+                del self.negative[oid]
+
+            self.misses += 1
+            return None
+
+    def put(self, oid: str, exists: bool) -> None:
+        with self.lock:
+            if exists:
+                self.negative.pop(oid, None)
+                if self.max_size > 0:
+                    self.positive[oid] = True
+                    self.positive.move_to_end(oid)
+                    while len(self.positive) > self.max_size:
+                        self.positive.popitem(last=False)
+
+            elif self.negative_ttl > 0 and self.max_negative_size > 0:
+                self.negative[oid] = self.clock() + self.negative_ttl
+                self.negative.move_to_end(oid)
+                while len(self.negative) > self.max_negative_size:
+                    self.negative.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.positive.clear()
+            self.negative.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'positive_size': len(self.positive),
+                'negative_size': len(self.negative)
+            }
+
+
+class CachingLargeFileStorage(LargeFileStorageWrapper):
+
+    def __init__(self, lfs: LargeFileStorage, cache: ExistenceCache):
+        super().__init__(lfs)
+        self.cache = cache
+
+    def exists(self, oid: str) -> bool:
+        exists = self.cache.get(oid)
+        if exists is None:
+            exists = self.lfs.exists(oid)
+            self.cache.put(oid, exists)
+
+        return exists
+
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        found, unknown = set(), []
+        for oid in oids:
+            exists = self.cache.get(oid)
+            if exists is None:
+                unknown.append(oid)
+            elif exists:
+                found.add(oid)
+
+        if unknown:
+            existing = self.lfs.exists_many(unknown)
+            for oid in unknown:
+                self.cache.put(oid, oid in existing)
+            found.update(existing)
+
+        return found
+
+    def size(self, oid: str) -> Optional[int]:
+        # verify and size checks confirm uploads, which must clear a remembered miss
+        size = self.lfs.size(oid)
+        if size is not None:
+            self.cache.put(oid, True)
+
+        return size
+
+    def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        sizes = self.lfs.sizes_many(oids)
+        for oid in sizes:
+            self.cache.put(oid, True)
+
+        return sizes
+
+
+class BloomFilter:
+    magic = b'LFSB'
+
+    def __init__(self, size: int, hashes: int, bits: bytearray = None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @staticmethod
+    def for_capacity(capacity: int, error_rate: float) -> BloomFilter:
+        size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        return BloomFilter(size, max(1, round(size / capacity * math.log(2))))
+
+    def positions(self, oid: str) -> Iterator[int]:
+        # oids are sha256 digests, so their own bits serve as independent hash values
+        h1, h2 = int(oid[:16], 16), int(oid[16:32], 16) | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, oid: str) -> None:
+        for position in self.positions(oid):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, oid: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(oid))
+
+    def to_bytes(self) -> bytes:
+        return self.magic + struct.pack('>QI', self.size, self.hashes) + bytes(self.bits)
+
+    @staticmethod
+    def from_bytes(data: bytes) -> BloomFilter:
+        if data[:4] != BloomFilter.magic or len(data) < 16:
+            raise ValueError('Invalid bloom filter snapshot')
+
+        size, hashes = struct.unpack_from('>QI', data, 4)
+        bits = bytearray(data[16:])
+        if len(bits) != (size + 7) // 8:
+            raise ValueError('Invalid bloom filter snapshot')
+
+        return BloomFilter(size, hashes, bits)
+
+
+class OidIndex:
+
+    def __init__(self, load: Callable[[], Tuple[Optional[bytes], Optional[str]]],
+                 save: Callable[[bytes, Optional[str]], bool], scan: Callable[[], Iterable[str]] = None,
+                 capacity: int = 1000000, error_rate: float = 0.01, max_age: float = 60, retries: int = 3,
+                 executor: Executor = None, clock: Callable[[], float] = time.monotonic):
+        self.load = load
+        self.save = save
+        self.scan = scan
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self.retries = retries
+        self.executor = executor
+        self.clock = clock
+        self.filter: Optional[BloomFilter] = None
+        self.pending: Set[str] = set()
+        self.loaded_at: Optional[float] = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def maybe_present(self, oids: Iterable[str]) -> List[str]:
+        bloom = self.current()
+        if bloom is None:
+            return list(oids)
+
+        return [oid for oid in oids if not _OID_PATTERN.fullmatch(oid) or oid in bloom]
+
+    def add(self, oids: Iterable[str]) -> None:
+        self.current()
+        with self.lock:
+            for oid in filter(_OID_PATTERN.fullmatch, oids):
+                if self.filter is None or oid not in self.filter:
+                    self.pending.add(oid)
+                    if self.filter is not None:
+                        self.filter.add(oid)
+
+    def current(self) -> Optional[BloomFilter]:
+        with self.lock:
+            if self.refreshing or (self.loaded_at is not None and self.clock() - self.loaded_at < self.max_age):
+                return self.filter
+
+            self.refreshing = True
+
+        # storage I/O stays off the request path, until the first snapshot is loaded every oid is maybe present
+        if self.executor is not None:
+            self.executor.submit(self.refresh)
+        else:
+            threading.Thread(target=self.refresh, daemon=True).start()
+
+        return self.filter
+
+    def refresh(self) -> None:
+        try:
+            for _ in range(self.retries):
+                if self.publish():
+                    return
+
+            logging.getLogger(__name__).warning('Unable to publish the oid index, the snapshot keeps changing')
+        except Exception:
+            logging.getLogger(__name__).warning('Unable to refresh the oid index', exc_info=True)
+        finally:
+            with self.lock:
+                self.loaded_at = self.clock()
+                self.refreshing = False
+
+    def publish(self) -> bool:
+        data, etag = self.load()
+        if data is None and self.scan is None:
+            with self.lock:
+                self.filter = None
+                self.pending.clear()
+            return True
+
+        if data is None:
+            bloom = BloomFilter.for_capacity(self.capacity, self.error_rate)
+            for oid in self.scan():
+                bloom.add(oid)
+        else:
+            bloom = BloomFilter.from_bytes(data)
+
+        with self.lock:
+            published = set(self.pending)
+
+        # the write is conditional on the loaded version, so a concurrent publish by another
+        # instance is never overwritten and the additions are replayed on top of it instead
+        for oid in published:
+            bloom.add(oid)
+        if (data is None or published) and not self.save(bloom.to_bytes(), etag):
+            return False
+
+        with self.lock:
+            self.pending -= published
+            for oid in self.pending:
+                bloom.add(oid)
+            self.filter = bloom
+
+        return True
+
+
+def oids_of(keys: Iterable[str]) -> Iterator[str]:
+    for key in keys:
+        name = key.rsplit('/', 1)[-1]
+        if _OID_PATTERN.fullmatch(name):
+            yield name
+
+
+class PresignCache:
+
+    def __init__(self, max_size: int = 0, min_lifetime: float = 900, clock: Callable[[], float] = time.time):
+        self.max_size = max_size
+        self.min_lifetime = min_lifetime
+        self.clock = clock
+        self.actions: OrderedDict[Tuple[str, str], Tuple[BatchResponse.ObjectLfs.Action, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, operation: str, oid: str) -> Optional[Tuple[BatchResponse.ObjectLfs.Action, float]]:
+        key = (operation, oid)
+        with self.lock:
+            entry = self.actions.get(key)
+            if entry is not None:
+                if entry[1] - self.clock() >= self.min_lifetime:
+                    self.actions.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self.actions[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, operation: str, oid: str, action: BatchResponse.ObjectLfs.Action, expires: float) -> None:
+        key = (operation, oid)
+        with self.lock:
+            self.actions[key] = (action, expires)
+            self.actions.move_to_end(key)
+            while len(self.actions) > self.max_size:
+                self.actions.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.actions.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.actions)
+            }
+
+
+class PresignCachingLargeFileStorage(LargeFileStorageWrapper):
+
+    def __init__(self, lfs: LargeFileStorage, cache: PresignCache, expires_in: int = 3600):
+        super().__init__(lfs)
+        self.cache = cache
+        self.expires_in = expires_in
+
+    def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        return self.prepare('download', oid, size, self.lfs.prepare_download)
+
+    def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        return self.prepare('upload', oid, size, self.lfs.prepare_upload)
+
+    def prepare(self, operation: str, oid: str, size: int,
+                fn: Callable[[str, int], BatchResponse.ObjectLfs.Action]) -> BatchResponse.ObjectLfs.Action:
+        entry = self.cache.get(operation, oid)
+        if entry is None:
+            signed_at = self.cache.clock()
+            action = fn(oid, size)
+            if action is None:
+                return action
+
+            entry = (action, self.expiry(action, signed_at))
+            self.cache.put(operation, oid, *entry)
+
+        action, expires = entry
+        return BatchResponse.ObjectLfs.Action(
+            href=action.href,
+            header=dict(action.header) if action.header else {},
+            expires_in=max(int(expires - self.cache.clock()), 0),
+            expires_at=datetime.fromtimestamp(int(expires), timezone.utc).isoformat()
+        )
+
+    def expiry(self, action: BatchResponse.ObjectLfs.Action, signed_at: float) -> float:
+        if action.expires_at:
+            return datetime.fromisoformat(action.expires_at.replace('Z', '+00:00')).timestamp()
+
+        if action.expires_in:
+            return signed_at + action.expires_in
+
+        return signed_at + self.expires_in
+
+
+class InstrumentedLargeFileStorage(LargeFileStorageWrapper):
+
+    def __init__(self, lfs: LargeFileStorage, instrumentation: Instrumentation):
+        super().__init__(lfs)
+        self.instrumentation = instrumentation
+
+    def exists(self, oid: str) -> bool:
+        with self.instrumentation.measure('storage.exists', 1):
+            return self.lfs.exists(oid)
+
+    def exists_many(self, oids: Iterable[str]) -> Set[str]:
+        oids = list(oids)
+        with self.instrumentation.measure('storage.exists_many', len(oids)):
+            return self.lfs.exists_many(oids)
+
+    def size(self, oid: str) -> Optional[int]:
+        with self.instrumentation.measure('storage.size', 1):
+            return self.lfs.size(oid)
+
+    def sizes_many(self, oids: Iterable[str]) -> Dict[str, int]:
+        oids = list(oids)
+        with self.instrumentation.measure('storage.sizes_many', len(oids)):
+            return self.lfs.sizes_many(oids)
+
+    def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        with self.instrumentation.measure('storage.prepare_download', 1):
+            return self.lfs.prepare_download(oid, size)
+
+    def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
+        with self.instrumentation.measure('storage.prepare_upload', 1):
+            return self.lfs.prepare_upload(oid, size)
+
+    def prepare_multipart_upload(self, oid: str, size: int, part_size: int) -> MultipartUpload:
+        with self.instrumentation.measure('storage.prepare_multipart_upload', 1):
+            return self.lfs.prepare_multipart_upload(oid, size, part_size)
+
+
+class BatchFacade:
+
+    def __init__(self, lfs: LargeFileStorage, executor: Executor = None, max_concurrency: int = None,
+                 streaming: bool = False, window_size: int = 1000, instrumentation: Instrumentation = None,
+                 skip_existing_uploads: bool = True, verify_upload_size: bool = False, verify_endpoint: str = None,
+                 part_size: int = None, oid_index: OidIndex = None):
+        self.instrumentation = instrumentation or Instrumentation()
+        self.lfs = lfs
+        if type(self.instrumentation).record is not Instrumentation.record:
+            self.lfs = InstrumentedLargeFileStorage(lfs, self.instrumentation)
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self.streaming = streaming
+        self.window_size = window_size
+        self.skip_existing_uploads = skip_existing_uploads
+        self.verify_upload_size = verify_upload_size
+        self.verify_endpoint = verify_endpoint
+        self.part_size = part_size
+        self.transfers = ('multipart', 'basic') if part_size else ('basic',)
+        self.oid_index = oid_index
+
     def process(self, request: HttpRequest) -> HttpResponse:
+        with self.instrumentation.measure('parse'):
+            batch_request = self.parse_request(request, self.streaming)
+
+        return self.create_response(self.batch_request(batch_request))
+
+    @staticmethod
+    def parse_request(request: HttpRequest, streaming: bool = False) -> BatchRequest:
         if request.path != '/objects/batch' or request.method != 'POST':
             raise HttpError(404, 'Not found')
 
         if 'application/vnd.git-lfs+json' not in request.headers.get('Accept', ''):
             raise HttpError(406, 'Not Acceptable')
 
+        if streaming:
+            return BatchRequestReader(request.body).read()
+
         body = json.loads(request.body)
 
-        response = self.batch_request(
-            BatchRequest(
-                operation=body['operation'],
-                transfers=body.get('transfers', ['basic', ]),
-                ref=BatchRequest.RefSpec(body['ref']['name']) if body.get('ref') else None,
-                objects=[BatchRequest.ObjectLfs(obj['oid'], obj['size']) for obj in body['objects']]
-            )
+        return BatchRequest(
+            operation=body['operation'],
+            transfers=body.get('transfers', ['basic', ]),
+            ref=BatchRequest.RefSpec(body['ref']['name']) if body.get('ref') else None,
+            objects=[BatchRequest.ObjectLfs(obj['oid'], obj['size']) for obj in body['objects']]
         )
 
+    @staticmethod
+    def create_response(response: BatchResponse) -> HttpResponse:
         return HttpResponse(
             status_code=200,
             headers={
@@ -162,35 +1264,331 @@ class BatchFacade:
             body=response
         )
 
-    def batch_request(self, request: BatchRequest) -> BatchResponse:
-        if 'basic' not in request.transfers:
+    @staticmethod
+    def negotiate_transfer(request: BatchRequest, transfers: Iterable[str]) -> str:
+        return next((transfer for transfer in transfers if transfer in request.transfers), 'basic')
+
+    @staticmethod
+    def validate_request(request: BatchRequest, transfer: str = 'basic') -> None:
+        if transfer not in request.transfers:
+            raise HttpError(422, 'Unprocessable Entity')
+
+        if request.operation not in ('download', 'upload'):
             raise HttpError(422, 'Unprocessable Entity')
 
-        objects = []
-        for obj in request.objects:
-            result = BatchResponse.ObjectLfs(obj.oid, obj.size)
+    @staticmethod
+    def validate_object(obj: BatchRequest.ObjectLfs) -> Optional[BatchResponse.ObjectLfs]:
+        if not isinstance(obj.oid, str) or not _OID_PATTERN.fullmatch(obj.oid):
+            error = BatchResponse.ObjectLfs.Error(422, 'Invalid object id')
+        elif type(obj.size) is not int or obj.size < 0:
+            error = BatchResponse.ObjectLfs.Error(422, 'Invalid object size')
+        else:
+            return None
+
+        return BatchResponse.ObjectLfs(obj.oid, obj.size, error=error)
+
+    @staticmethod
+    def coalesce(objects: List[BatchRequest.ObjectLfs],
+                 rejected: List[Optional[BatchResponse.ObjectLfs]]) -> List[BatchRequest.ObjectLfs]:
+        unique = {}
+        for obj, error in zip(objects, rejected):
+            if error is None:
+                unique.setdefault((obj.oid, obj.size), obj)
+        return list(unique.values())
+
+    @staticmethod
+    def fan_out(objects: List[BatchRequest.ObjectLfs], rejected: List[Optional[BatchResponse.ObjectLfs]],
+                results: List[BatchResponse.ObjectLfs]) -> List[BatchResponse.ObjectLfs]:
+        prepared = {(result.oid, result.size): result for result in results}
+        return [error if error is not None else prepared[(obj.oid, obj.size)] for obj, error in zip(objects, rejected)]
+
+    @staticmethod
+    def upload_required(obj: BatchRequest.ObjectLfs, stored: Dict[str, Optional[int]],
+                        skip_existing: bool, verify_size: bool) -> bool:
+        if not skip_existing or obj.oid not in stored:
+            return True
+
+        return verify_size and stored[obj.oid] != obj.size
+
+    @staticmethod
+    def upload_actions(upload: Union[BatchResponse.ObjectLfs.Action, MultipartUpload],
+                       verify_endpoint: Optional[str]) -> Dict[str, Any]:
+        if isinstance(upload, MultipartUpload):
+            actions = {'parts': upload.parts}
+            if upload.commit is not None:
+                actions['commit'] = upload.commit
+            if upload.abort is not None:
+                actions['abort'] = upload.abort
+        else:
+            actions = {'upload': upload}
+
+        if verify_endpoint is not None:
+            actions['verify'] = BatchResponse.ObjectLfs.Action(href=f'{verify_endpoint}objects/verify')
+
+        return actions
+
+    def batch_request(self, request: BatchRequest) -> BatchResponse:
+        if self.streaming and len(self.transfers) > 1 and not isinstance(request.objects, list):
+            # git-lfs sends the transfers after the objects, so the adapter is only known once they are read
+            request.objects = list(request.objects)
+
+        transfer = self.negotiate_transfer(request, self.transfers)
+        self.validate_request(request, transfer)
+        self.instrumentation.annotate(operation=request.operation, transfer=transfer)
+
+        objects = self.iter_objects(request, transfer)
+        if not self.streaming:
+            objects = list(objects)
+
+        return BatchResponse(transfer=transfer, objects=objects)
+
+    def iter_objects(self, request: BatchRequest, transfer: str = 'basic') -> Iterator[BatchResponse.ObjectLfs]:
+        count = 0
+        for window in self.windows(request.objects):
+            count += len(window)
+            yield from self.batch_window(request.operation, window, transfer)
+
+        self.instrumentation.annotate(objects=count)
+        # a streamed request body may list the transfers after the objects
+        self.validate_request(request, transfer)
+
+    def batch_window(self, operation: str, window: List[BatchRequest.ObjectLfs],
+                     transfer: str = 'basic') -> List[BatchResponse.ObjectLfs]:
+        rejected = [self.validate_object(obj) for obj in window]
+        unique = self.coalesce(window, rejected)
+
+        stored = {}
+        if unique and (operation == 'download' or self.skip_existing_uploads):
+            with self.instrumentation.measure('exists', len(unique)):
+                stored = self.lookup(operation, list(dict.fromkeys(obj.oid for obj in unique)))
+
+        with self.instrumentation.measure('prepare', len(unique)) as measurement:
+            objects = self.map(
+                lambda obj: self.batch_object(operation, obj, stored, transfer),
+                unique
+            )
+            measurement.errors = sum(1 for obj in objects if obj.error is not None)
+
+        return self.fan_out(window, rejected, objects)
+
+    def lookup(self, operation: str, oids: List[str]) -> Dict[str, Optional[int]]:
+        if self.oid_index is not None and operation == 'upload':
+            # only uploads trust "definitely absent": a stale snapshot costs a re-upload there, not a 404
+            oids = self.oid_index.maybe_present(oids)
+            if not oids:
+                return {}
+
+        if operation == 'upload' and self.verify_upload_size:
+            stored = self.lfs.sizes_many(oids)
+        else:
+            stored = dict.fromkeys(self.lfs.exists_many(oids))
+
+        if self.oid_index is not None and operation == 'download':
+            self.oid_index.add(stored)
+
+        return stored
+
+    def windows(self, objects: Iterable[BatchRequest.ObjectLfs]) -> Iterator[List[BatchRequest.ObjectLfs]]:
+        objects = iter(objects)
+        while True:
+            window = list(itertools.islice(objects, self.window_size))
+            if not window:
+                return
+            yield window
+
+    def batch_object(self, operation: str, obj: BatchRequest.ObjectLfs,
+                     stored: Dict[str, Optional[int]], transfer: str = 'basic') -> BatchResponse.ObjectLfs:
+        result = BatchResponse.ObjectLfs(obj.oid, obj.size)
+        try:
+            result.authenticated = True
+
+            if operation == 'download':
+                if obj.oid not in stored:
+                    raise BatchError(404, 'The object does not exist on the server')
+
+                result.actions = {
+                    'download': self.lfs.prepare_download(obj.oid, obj.size)
+                }
+
+            elif self.upload_required(obj, stored, self.skip_existing_uploads, self.verify_upload_size):
+                if transfer == 'multipart':
+                    upload = self.lfs.prepare_multipart_upload(obj.oid, obj.size, self.part_size)
+                else:
+                    upload = self.lfs.prepare_upload(obj.oid, obj.size)
+
+                result.actions = self.upload_actions(upload, self.verify_endpoint)
+
+        except BatchError as be:
+            result.error = BatchResponse.ObjectLfs.Error(be.code, be.message)
+
+        return result
+
+    def map(self, fn: Callable[[Any], Any], items: Iterable[Any]) -> List[Any]:
+        if self.executor is None:
+            return [fn(item) for item in items]
+
+        semaphore = threading.BoundedSemaphore(self.max_concurrency) if self.max_concurrency else None
+
+        def task(item):
             try:
-                result.authenticated = True
+                return fn(item)
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+        futures = []
+        for item in items:
+            if semaphore is not None:
+                semaphore.acquire()
+            futures.append(self.executor.submit(task, item))
 
-                if request.operation == 'download':
-                    if not self.lfs.exists(obj.oid):
-                        raise BatchError(404, 'The object does not exist on the server')
+        return [future.result() for future in futures]
 
-                    result.actions = {
-                        'download': self.lfs.prepare_download(obj.oid, obj.size)
-                    }
 
-                elif request.operation == 'upload':
-                    result.actions = {
-                        'upload': self.lfs.prepare_upload(obj.oid, obj.size)
-                    }
+class AsyncBatchFacade:
 
+    def __init__(self, lfs: AsyncLargeFileStorage, max_concurrency: int = None,
+                 instrumentation: Instrumentation = None, skip_existing_uploads: bool = True,
+                 verify_upload_size: bool = False, verify_endpoint: str = None, part_size: int = None,
+                 oid_index: OidIndex = None):
+        self.lfs = lfs
+        self.max_concurrency = max_concurrency
+        self.instrumentation = instrumentation or Instrumentation()
+        self.skip_existing_uploads = skip_existing_uploads
+        self.verify_upload_size = verify_upload_size
+        self.verify_endpoint = verify_endpoint
+        self.part_size = part_size
+        self.transfers = ('multipart', 'basic') if part_size else ('basic',)
+        self.oid_index = oid_index
+
+    async def process(self, request: HttpRequest) -> HttpResponse:
+        with self.instrumentation.measure('parse'):
+            batch_request = BatchFacade.parse_request(request)
+
+        return BatchFacade.create_response(await self.batch_request(batch_request))
+
+    async def batch_request(self, request: BatchRequest) -> BatchResponse:
+        transfer = BatchFacade.negotiate_transfer(request, self.transfers)
+        BatchFacade.validate_request(request, transfer)
+        self.instrumentation.annotate(operation=request.operation, transfer=transfer, objects=len(request.objects))
+
+        rejected = [BatchFacade.validate_object(obj) for obj in request.objects]
+        unique = BatchFacade.coalesce(request.objects, rejected)
+
+        stored = {}
+        if unique and (request.operation == 'download' or self.skip_existing_uploads):
+            with self.instrumentation.measure('exists', len(unique)):
+                stored = await self.lookup(request.operation, list(dict.fromkeys(obj.oid for obj in unique)))
+
+        semaphore = asyncio.Semaphore(self.max_concurrency) if self.max_concurrency else None
+
+        async def task(obj):
+            if semaphore is None:
+                return await self.batch_object(request.operation, obj, stored, transfer)
+
+            async with semaphore:
+                return await self.batch_object(request.operation, obj, stored, transfer)
+
+        with self.instrumentation.measure('prepare', len(unique)) as measurement:
+            objects = await asyncio.gather(*(task(obj) for obj in unique))
+            measurement.errors = sum(1 for obj in objects if obj.error is not None)
+
+        return BatchResponse(transfer=transfer, objects=BatchFacade.fan_out(request.objects, rejected, objects))
+
+    async def lookup(self, operation: str, oids: List[str]) -> Dict[str, Optional[int]]:
+        if self.oid_index is not None and operation == 'upload':
+            oids = await asyncio.get_running_loop().run_in_executor(None, self.oid_index.maybe_present, oids)
+            if not oids:
+                return {}
+
+        if operation == 'upload' and self.verify_upload_size:
+            stored = await self.lfs.sizes_many(oids)
+        else:
+            stored = dict.fromkeys(await self.lfs.exists_many(oids))
+
+        if self.oid_index is not None and operation == 'download':
+            await asyncio.get_running_loop().run_in_executor(None, self.oid_index.add, list(stored))
+
+        return stored
+
+    async def batch_object(self, operation: str, obj: BatchRequest.ObjectLfs,
+                           stored: Dict[str, Optional[int]], transfer: str = 'basic') -> BatchResponse.ObjectLfs:
+        result = BatchResponse.ObjectLfs(obj.oid, obj.size)
+        try:
+            result.authenticated = True
+
+            if operation == 'download':
+                if obj.oid not in stored:
+                    raise BatchError(404, 'The object does not exist on the server')
+
+                result.actions = {
+                    'download': await self.lfs.prepare_download(obj.oid, obj.size)
+                }
+
+            elif BatchFacade.upload_required(obj, stored, self.skip_existing_uploads, self.verify_upload_size):
+                if transfer == 'multipart':
+                    upload = await self.lfs.prepare_multipart_upload(obj.oid, obj.size, self.part_size)
                 else:
-                    raise HttpError(422, 'Unprocessable Entity')
+                    upload = await self.lfs.prepare_upload(obj.oid, obj.size)
+
+                result.actions = BatchFacade.upload_actions(upload, self.verify_endpoint)
+
+        except BatchError as be:
+            result.error = BatchResponse.ObjectLfs.Error(be.code, be.message)
+
+        return result
+
+
+class VerifyFacade:
+
+    def __init__(self, lfs: LargeFileStorage, instrumentation: Instrumentation = None, oid_index: OidIndex = None):
+        self.instrumentation = instrumentation or Instrumentation()
+        self.oid_index = oid_index
+        self.lfs = lfs
+        if type(self.instrumentation).record is not Instrumentation.record:
+            self.lfs = InstrumentedLargeFileStorage(lfs, self.instrumentation)
+
+    def process(self, request: HttpRequest) -> HttpResponse:
+        with self.instrumentation.measure('parse'):
+            verify_request = self.parse_request(request)
+
+        self.instrumentation.annotate(operation='verify', objects=1)
+        with self.instrumentation.measure('verify', 1):
+            self.verify(verify_request)
+
+        return HttpResponse(
+            status_code=200,
+            headers={
+                'Content-Type': 'application/vnd.git-lfs+json'
+            },
+            body=verify_request
+        )
+
+    @staticmethod
+    def parse_request(request: HttpRequest) -> VerifyRequest:
+        if request.path != '/objects/verify' or request.method != 'POST':
+            raise HttpError(404, 'Not found')
+
+        if 'application/vnd.git-lfs+json' not in request.headers.get('Accept', ''):
+            raise HttpError(406, 'Not Acceptable')
+
+        body = json.loads(request.body)
+        if not isinstance(body.get('oid'), str) or type(body.get('size')) is not int:
+            raise HttpError(422, 'Unprocessable Entity')
+
+        return VerifyRequest(body['oid'], body['size'])
+
+    def verify(self, request: VerifyRequest) -> None:
+        # the oid becomes a storage key, so anything but a sha256 digest is rejected before it is looked up
+        if BatchFacade.validate_object(BatchRequest.ObjectLfs(request.oid, request.size)) is not None:
+            raise HttpError(422, 'Unprocessable Entity')
 
-            except BatchError as be:
-                result.error = BatchResponse.ObjectLfs.Error(be.code, be.message)
+        size = self.lfs.size(request.oid)
+        if size is None:
+            raise HttpError(404, 'The object does not exist on the server')
 
-            objects.append(result)
+        if size != request.size:
+            raise HttpError(422, 'The object size does not match')
 
-        return BatchResponse(transfer='basic', objects=objects)
+        if self.oid_index is not None:
+            self.oid_index.add([request.oid])
@@ -1,8 +1,20 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 from core import *
 
+OID = hashlib.sha256(b'foo').hexdigest()
+OTHER_OID = hashlib.sha256(b'bar').hexdigest()
+MISSING_OID = hashlib.sha256(b'baz').hexdigest()
+
 
 class CoreTestCase(unittest.TestCase):
     def test_dataclass_as_dict(self):
@@ -53,6 +65,47 @@ class CoreTestCase(unittest.TestCase):
             actual
         )
 
+    def test_batch_response_as_json(self):
+        with open('resources/batch_response.json', 'r') as f:
+            expected = f.read()
+        response = BatchResponse(
+            'basic',
+            [
+                BatchResponse.ObjectLfs(
+                    oid='1111111',
+                    size=123,
+                    authenticated=True,
+                    actions={
+                        'download': BatchResponse.ObjectLfs.Action(
+                            href='https://some-download.com',
+                            header={'Key': 'value'},
+                            expires_at='2016-11-10T15:29:07Z'
+                        )
+                    }
+                )
+            ]
+        )
+
+        self.assertEqual(json.dumps(response.as_dict(), indent=2), expected)
+        self.assertEqual(response.as_json(), json.dumps(json.loads(expected)))
+
+    def test_batch_response_iter_json(self):
+        response = BatchResponse('basic', [BatchResponse.ObjectLfs('a', 1), None, BatchResponse.ObjectLfs('b', 2)])
+
+        self.assertEqual(''.join(response.iter_json()), response.as_json())
+        self.assertEqual(''.join(BatchResponse('basic', []).iter_json()), BatchResponse('basic', []).as_json())
+
+    def test_batch_response_slots(self):
+        action = BatchResponse.ObjectLfs.Action('url')
+        obj = BatchResponse.ObjectLfs('oid', 123, actions={'download': action})
+
+        self.assertFalse(hasattr(action, '__dict__'))
+        self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertEqual(action.header, {})
+        self.assertIsNone(action.expires_in)
+        self.assertIsNone(obj.error)
+        self.assertEqual(BatchResponse.ObjectLfs.Action.__qualname__, 'BatchResponse.ObjectLfs.Action')
+
 
 class BatchFacadeTestCase(unittest.TestCase):
 
@@ -139,7 +192,7 @@ class BatchFacadeTestCase(unittest.TestCase):
             'delete',
             [
                 BatchRequest.ObjectLfs(
-                    'QaX1WsC2EdC3',
+                    OID,
                     123
                 )
             ]
@@ -149,13 +202,13 @@ class BatchFacadeTestCase(unittest.TestCase):
             self.batch_facade.batch_request(batch_request)
 
     def test_batch_request_download_operation(self):
-        self.mock_lfs.exists.return_value = True
+        self.mock_lfs.exists_many.return_value = {OID}
         self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
         batch_request = BatchRequest(
             'download',
             [
                 BatchRequest.ObjectLfs(
-                    'QaX1WsC2EdC3',
+                    OID,
                     123
                 )
             ]
@@ -165,22 +218,23 @@ class BatchFacadeTestCase(unittest.TestCase):
 
         self.assertIsNotNone(actual)
         self.assertEqual(actual.transfer, 'basic')
-        self.assertEqual(actual.objects[0].oid, 'QaX1WsC2EdC3')
+        self.assertEqual(actual.objects[0].oid, OID)
         self.assertEqual(actual.objects[0].size, 123)
         self.assertTrue(actual.objects[0].authenticated)
         self.assertEqual(actual.objects[0].actions['download'].href, 'url')
         self.assertIsNone(actual.objects[0].actions.get('upload'))
         self.assertIsNone(actual.objects[0].error)
-        self.mock_lfs.exists.assert_called_once_with('QaX1WsC2EdC3')
-        self.mock_lfs.prepare_download.assert_called_once_with('QaX1WsC2EdC3', 123)
+        self.mock_lfs.exists_many.assert_called_once_with([OID])
+        self.mock_lfs.prepare_download.assert_called_once_with(OID, 123)
 
     def test_batch_request_upload_operation(self):
+        self.mock_lfs.exists_many.return_value = set()
         self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
         batch_request = BatchRequest(
             'upload',
             [
                 BatchRequest.ObjectLfs(
-                    'QaX1WsC2EdC3',
+                    OID,
                     123
                 )
             ]
@@ -190,21 +244,160 @@ class BatchFacadeTestCase(unittest.TestCase):
 
         self.assertIsNotNone(actual)
         self.assertEqual(actual.transfer, 'basic')
-        self.assertEqual(actual.objects[0].oid, 'QaX1WsC2EdC3')
+        self.assertEqual(actual.objects[0].oid, OID)
         self.assertEqual(actual.objects[0].size, 123)
         self.assertTrue(actual.objects[0].authenticated)
         self.assertEqual(actual.objects[0].actions['upload'].href, 'url')
         self.assertIsNone(actual.objects[0].actions.get('download'))
         self.assertIsNone(actual.objects[0].error)
-        self.mock_lfs.prepare_upload.assert_called_once_with('QaX1WsC2EdC3', 123)
+        self.mock_lfs.prepare_upload.assert_called_once_with(OID, 123)
+        self.mock_lfs.exists_many.assert_called_once_with([OID])
+
+    def test_batch_request_upload_operation_object_exists(self):
+        self.mock_lfs.exists_many.return_value = {OID}
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 123)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertTrue(actual.objects[0].authenticated)
+        self.assertIsNone(actual.objects[0].actions)
+        self.assertIsNone(actual.objects[0].error)
+        self.assertEqual(
+            actual.as_dict()['objects'][0], {'oid': OID, 'size': 123, 'authenticated': True})
+        self.mock_lfs.prepare_upload.assert_not_called()
+
+    def test_batch_request_upload_operation_verify_size(self):
+        self.batch_facade.verify_upload_size = True
+        self.mock_lfs.sizes_many.return_value = {OID: 123, OTHER_OID: 1}
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest(
+            'upload',
+            [
+                BatchRequest.ObjectLfs(OID, 123),
+                BatchRequest.ObjectLfs(OTHER_OID, 987)
+            ]
+        )
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertIsNone(actual.objects[0].actions)
+        self.assertEqual(actual.objects[1].actions['upload'].href, 'url')
+        self.mock_lfs.sizes_many.assert_called_once_with([OID, OTHER_OID])
+        self.mock_lfs.exists_many.assert_not_called()
+        self.mock_lfs.prepare_upload.assert_called_once_with(OTHER_OID, 987)
+
+    def test_batch_request_upload_operation_skip_existing_disabled(self):
+        self.batch_facade.skip_existing_uploads = False
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 123)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual(actual.objects[0].actions['upload'].href, 'url')
+        self.mock_lfs.exists_many.assert_not_called()
+        self.mock_lfs.sizes_many.assert_not_called()
+
+    def test_batch_request_upload_operation_verify_action(self):
+        self.batch_facade.verify_endpoint = 'https://lfs.example.com/'
+        self.mock_lfs.exists_many.return_value = set()
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 123)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual(actual.objects[0].actions['upload'].href, 'url')
+        self.assertEqual(actual.objects[0].actions['verify'].href, 'https://lfs.example.com/objects/verify')
+
+    def test_batch_request_multipart(self):
+        self.batch_facade = BatchFacade(self.mock_lfs, part_size=100)
+        self.mock_lfs.exists_many.return_value = set()
+        self.mock_lfs.prepare_multipart_upload.return_value = MultipartUpload(
+            parts=[
+                BatchResponse.ObjectLfs.Action('url/1', pos=0, size=100),
+                BatchResponse.ObjectLfs.Action('url/2', pos=100, size=23)
+            ],
+            commit=BatchResponse.ObjectLfs.Action('url/commit')
+        )
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 123)], transfers=['basic', 'multipart'])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual(actual.transfer, 'multipart')
+        self.assertEqual(actual.as_dict()['objects'][0]['actions'], {
+            'parts': [{'href': 'url/1', 'pos': 0, 'size': 100}, {'href': 'url/2', 'pos': 100, 'size': 23}],
+            'commit': {'href': 'url/commit'}
+        })
+        self.mock_lfs.prepare_multipart_upload.assert_called_once_with(OID, 123, 100)
+        self.mock_lfs.prepare_upload.assert_not_called()
+
+    def test_batch_request_multipart_not_requested(self):
+        self.batch_facade = BatchFacade(self.mock_lfs, part_size=100)
+        self.mock_lfs.exists_many.return_value = set()
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 123)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual(actual.transfer, 'basic')
+        self.assertEqual(actual.objects[0].actions['upload'].href, 'url')
+        self.mock_lfs.prepare_multipart_upload.assert_not_called()
+
+    def test_batch_request_multipart_disabled(self):
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 123)], transfers=['multipart'])
+
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Unprocessable Entity'):
+            self.batch_facade.batch_request(batch_request)
+
+    def test_batch_request_invalid_objects(self):
+        batch_request = BatchRequest(
+            'download',
+            [
+                BatchRequest.ObjectLfs('QaX1WsC2EdC3', 123),
+                BatchRequest.ObjectLfs(OID.upper(), 123),
+                BatchRequest.ObjectLfs(OID, -1),
+                BatchRequest.ObjectLfs(OID, '123')
+            ]
+        )
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual([obj.error.code for obj in actual.objects], [422, 422, 422, 422])
+        self.assertEqual(actual.objects[0].error.message, 'Invalid object id')
+        self.assertEqual(actual.objects[1].error.message, 'Invalid object id')
+        self.assertEqual(actual.objects[2].error.message, 'Invalid object size')
+        self.assertIsNone(actual.objects[3].authenticated)
+        self.mock_lfs.exists_many.assert_not_called()
+        self.mock_lfs.prepare_download.assert_not_called()
+
+    def test_batch_request_duplicate_objects(self):
+        self.mock_lfs.exists_many.return_value = {OID, OTHER_OID}
+        self.mock_lfs.prepare_download.side_effect = lambda oid, size: BatchResponse.ObjectLfs.Action(f'url/{oid}')
+        batch_request = BatchRequest(
+            'download',
+            [
+                BatchRequest.ObjectLfs(OID, 123),
+                BatchRequest.ObjectLfs(OTHER_OID, 987),
+                BatchRequest.ObjectLfs(OID, 123),
+                BatchRequest.ObjectLfs(OID, 456),
+                BatchRequest.ObjectLfs(OID, 123)
+            ]
+        )
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual([obj.size for obj in actual.objects], [123, 987, 123, 456, 123])
+        self.assertEqual(actual.objects[2].actions['download'].href, f'url/{OID}')
+        self.assertEqual(actual.objects[3].actions['download'].href, f'url/{OID}')
+        self.mock_lfs.exists_many.assert_called_once_with([OID, OTHER_OID])
+        self.assertEqual(self.mock_lfs.prepare_download.call_count, 3)
 
     def test_batch_request_download_object_not_exist(self):
-        self.mock_lfs.exists.return_value = False
+        self.mock_lfs.exists_many.return_value = set()
         batch_request = BatchRequest(
             'download',
             [
                 BatchRequest.ObjectLfs(
-                    'QaX1WsC2EdC3',
+                    OID,
                     123
                 )
             ]
@@ -214,7 +407,7 @@ class BatchFacadeTestCase(unittest.TestCase):
 
         self.assertIsNotNone(actual)
         self.assertEqual(actual.transfer, 'basic')
-        self.assertEqual(actual.objects[0].oid, 'QaX1WsC2EdC3')
+        self.assertEqual(actual.objects[0].oid, OID)
         self.assertEqual(actual.objects[0].size, 123)
         self.assertTrue(actual.objects[0].authenticated)
         self.assertIsNone(actual.objects[0].actions)
@@ -222,17 +415,17 @@ class BatchFacadeTestCase(unittest.TestCase):
         self.assertEqual(actual.objects[0].error.message, 'The object does not exist on the server')
 
     def test_batch_request(self):
-        self.mock_lfs.exists.return_value = True
+        self.mock_lfs.exists_many.return_value = {OID, OTHER_OID}
         self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
         batch_request = BatchRequest(
             'download',
             [
                 BatchRequest.ObjectLfs(
-                    'QaX1WsC2EdC3',
+                    OID,
                     123
                 ),
                 BatchRequest.ObjectLfs(
-                    'MkP0NjI9BhU8',
+                    OTHER_OID,
                     987
                 )
             ]
@@ -243,3 +436,1077 @@ class BatchFacadeTestCase(unittest.TestCase):
         self.assertIsNotNone(actual)
         self.assertEqual(actual.transfer, 'basic')
         self.assertEqual(len(actual.objects), 2)
+        self.mock_lfs.exists_many.assert_called_once_with([OID, OTHER_OID])
+
+    def test_batch_request_download_partially_exist(self):
+        self.mock_lfs.exists_many.return_value = {OTHER_OID}
+        self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest(
+            'download',
+            [
+                BatchRequest.ObjectLfs(
+                    OID,
+                    123
+                ),
+                BatchRequest.ObjectLfs(
+                    OTHER_OID,
+                    987
+                )
+            ]
+        )
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual(actual.objects[0].error.code, 404)
+        self.assertIsNone(actual.objects[0].actions)
+        self.assertIsNone(actual.objects[1].error)
+        self.assertEqual(actual.objects[1].actions['download'].href, 'url')
+        self.mock_lfs.exists.assert_not_called()
+        self.mock_lfs.prepare_download.assert_called_once_with(OTHER_OID, 987)
+
+
+class ConcurrentBatchFacadeTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_lfs = mock.MagicMock()
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        self.batch_facade = BatchFacade(self.mock_lfs, executor=self.executor, max_concurrency=3)
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+
+    def test_batch_request_keeps_order(self):
+        def prepare_download(oid, size):
+            time.sleep(0.001 * (size % 5))
+            return BatchResponse.ObjectLfs.Action(f'url/{oid}')
+
+        oids = [f'{i:064x}' for i in range(20)]
+        self.mock_lfs.exists_many.return_value = set(oids[1:])
+        self.mock_lfs.prepare_download.side_effect = prepare_download
+        batch_request = BatchRequest('download', [BatchRequest.ObjectLfs(oid, i) for i, oid in enumerate(oids)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual([obj.oid for obj in actual.objects], oids)
+        self.assertEqual(actual.objects[0].error.code, 404)
+        self.assertIsNone(actual.objects[0].actions)
+        for obj in actual.objects[1:]:
+            self.assertIsNone(obj.error)
+            self.assertEqual(obj.actions['download'].href, f'url/{obj.oid}')
+
+    def test_batch_request_max_concurrency(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def prepare_upload(oid, size):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.005)
+            with lock:
+                running[0] -= 1
+            return BatchResponse.ObjectLfs.Action('url')
+
+        self.mock_lfs.prepare_upload.side_effect = prepare_upload
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(f'{i:064x}', i) for i in range(12)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertEqual(len(actual.objects), 12)
+        self.assertLessEqual(running[1], 3)
+
+    def test_batch_request_batch_error(self):
+        def prepare_upload(oid, size):
+            if oid == f'{1:064x}':
+                raise BatchError(507, 'Insufficient Storage')
+            return BatchResponse.ObjectLfs.Action('url')
+
+        self.mock_lfs.prepare_upload.side_effect = prepare_upload
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(f'{i:064x}', i) for i in range(3)])
+
+        actual = self.batch_facade.batch_request(batch_request)
+
+        self.assertIsNone(actual.objects[0].error)
+        self.assertEqual(actual.objects[1].error.code, 507)
+        self.assertEqual(actual.objects[1].error.message, 'Insufficient Storage')
+        self.assertIsNone(actual.objects[2].error)
+
+    def test_shared_executor(self):
+        self.assertIsNone(shared_executor(0))
+        self.assertIsNone(shared_executor(None))
+        self.assertIs(shared_executor(2), shared_executor(2))
+
+
+class VerifyFacadeTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_lfs = mock.MagicMock()
+        self.verify_facade = VerifyFacade(self.mock_lfs)
+
+    @staticmethod
+    def request(body):
+        return HttpRequest(
+            '/objects/verify', 'POST',
+            headers={
+                'Accept': 'application/vnd.git-lfs+json'
+            },
+            body=json.dumps(body)
+        )
+
+    def test_not_found_incorrect_path(self):
+        request = HttpRequest('/objects/batch', 'POST')
+
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Not found'):
+            self.verify_facade.process(request)
+
+    def test_not_acceptable(self):
+        request = HttpRequest('/objects/verify', 'POST')
+
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Not Acceptable'):
+            self.verify_facade.process(request)
+
+    def test_process(self):
+        self.mock_lfs.size.return_value = 123
+
+        actual = self.verify_facade.process(self.request({'oid': OID, 'size': 123}))
+
+        self.assertEqual(actual.status_code, 200)
+        self.assertEqual(actual.headers['Content-Type'], 'application/vnd.git-lfs+json')
+        self.assertEqual(dataclass_as_dict(actual.body), {'oid': OID, 'size': 123})
+        self.mock_lfs.size.assert_called_once_with(OID)
+        self.mock_lfs.exists.assert_not_called()
+
+    def test_process_object_not_exist(self):
+        self.mock_lfs.size.return_value = None
+
+        with self.assertRaises(HttpError) as context:
+            self.verify_facade.process(self.request({'oid': OID, 'size': 123}))
+
+        self.assertEqual(context.exception.code, 404)
+
+    def test_process_size_mismatch(self):
+        self.mock_lfs.size.return_value = 100
+
+        with self.assertRaises(HttpError) as context:
+            self.verify_facade.process(self.request({'oid': OID, 'size': 123}))
+
+        self.assertEqual(context.exception.code, 422)
+        self.assertEqual(context.exception.message, 'The object size does not match')
+
+    def test_process_invalid_body(self):
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Unprocessable Entity'):
+            self.verify_facade.process(self.request({'oid': OID, 'size': '123'}))
+
+        self.mock_lfs.size.assert_not_called()
+
+    def test_process_invalid_oid(self):
+        for oid in ('../../../etc/passwd', OID.upper(), OID[:-1]):
+            with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Unprocessable Entity'):
+                self.verify_facade.process(self.request({'oid': oid, 'size': 123}))
+
+        self.mock_lfs.size.assert_not_called()
+
+
+class AsyncBatchFacadeTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_lfs = mock.MagicMock()
+        self.batch_facade = AsyncBatchFacade(ThreadOffloadLargeFileStorage(self.mock_lfs), max_concurrency=2)
+
+    def test_process(self):
+        self.mock_lfs.exists_many.return_value = {OID}
+        self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
+        with open('resources/batch_request.json', 'r') as f:
+            http_request = HttpRequest(
+                '/objects/batch', "POST",
+                headers={
+                    'Accept': 'application/vnd.git-lfs+json; charset=utf-8'
+                },
+                body=f.read()
+            )
+
+        actual = asyncio.run(self.batch_facade.process(http_request))
+
+        self.assertEqual(actual.status_code, 200)
+        self.assertEqual(actual.headers['Content-Type'], 'application/vnd.git-lfs+json')
+        self.assertEqual(actual.body.objects[0].oid, '12345678')
+        self.assertEqual(actual.body.objects[0].error.code, 422)
+        self.assertEqual(actual.body.objects[0].error.message, 'Invalid object id')
+        self.mock_lfs.exists_many.assert_not_called()
+
+    def test_not_found(self):
+        request = HttpRequest('/foo', "GET")
+
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Not found'):
+            asyncio.run(self.batch_facade.process(request))
+
+    def test_batch_request_unsupported_operation(self):
+        batch_request = BatchRequest('delete', [])
+
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Unprocessable Entity'):
+            asyncio.run(self.batch_facade.batch_request(batch_request))
+
+    def test_batch_request(self):
+        self.mock_lfs.exists_many.return_value = {OID, OTHER_OID}
+        self.mock_lfs.prepare_download.side_effect = lambda oid, size: BatchResponse.ObjectLfs.Action(f'url/{oid}')
+        batch_request = BatchRequest(
+            'download',
+            [
+                BatchRequest.ObjectLfs(OID, 123),
+                BatchRequest.ObjectLfs(MISSING_OID, 456),
+                BatchRequest.ObjectLfs(OTHER_OID, 987)
+            ]
+        )
+
+        actual = asyncio.run(self.batch_facade.batch_request(batch_request))
+
+        self.assertEqual(actual.transfer, 'basic')
+        self.assertEqual([obj.oid for obj in actual.objects], [OID, MISSING_OID, OTHER_OID])
+        self.assertEqual(actual.objects[0].actions['download'].href, f'url/{OID}')
+        self.assertEqual(actual.objects[1].error.code, 404)
+        self.assertEqual(actual.objects[2].actions['download'].href, f'url/{OTHER_OID}')
+        self.assertEqual(self.mock_lfs.prepare_download.call_count, 2)
+
+    def test_batch_request_upload_operation(self):
+        self.mock_lfs.exists_many.return_value = {OTHER_OID}
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest(
+            'upload',
+            [
+                BatchRequest.ObjectLfs(OID, 123),
+                BatchRequest.ObjectLfs(OTHER_OID, 987)
+            ]
+        )
+
+        actual = asyncio.run(self.batch_facade.batch_request(batch_request))
+
+        self.assertEqual(actual.objects[0].actions['upload'].href, 'url')
+        self.assertIsNone(actual.objects[1].actions)
+        self.assertTrue(actual.objects[1].authenticated)
+        self.mock_lfs.exists_many.assert_called_once_with([OID, OTHER_OID])
+        self.mock_lfs.prepare_upload.assert_called_once_with(OID, 123)
+
+
+class StreamingBatchFacadeTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_lfs = mock.MagicMock()
+        self.batch_facade = BatchFacade(self.mock_lfs, streaming=True, window_size=2)
+
+    def test_process(self):
+        self.mock_lfs.exists_many.side_effect = lambda oids: set(oids)
+        self.mock_lfs.prepare_download.side_effect = lambda oid, size: BatchResponse.ObjectLfs.Action(f'url/{oid}')
+        body = json.dumps({
+            'operation': 'download',
+            'objects': [{'oid': f'{i:064x}', 'size': i} for i in range(5)],
+            'transfers': ['basic'],
+            'ref': {'name': 'refs/heads/master'}
+        }).encode()
+        http_request = HttpRequest(
+            '/objects/batch', "POST",
+            headers={
+                'Accept': 'application/vnd.git-lfs+json; charset=utf-8'
+            },
+            body=(body[i:i + 7] for i in range(0, len(body), 7))
+        )
+
+        actual = self.batch_facade.process(http_request)
+
+        self.mock_lfs.exists_many.assert_not_called()
+        objects = list(actual.body.objects)
+        self.assertEqual([obj.oid for obj in objects], [f'{i:064x}' for i in range(5)])
+        self.assertEqual(objects[4].actions['download'].href, f'url/{4:064x}')
+        self.assertEqual(
+            [c[0][0] for c in self.mock_lfs.exists_many.call_args_list],
+            [[f'{i:064x}' for i in window] for window in ([0, 1], [2, 3], [4])]
+        )
+
+    def test_process_unsupported_transfers_after_objects(self):
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        http_request = HttpRequest(
+            '/objects/batch', "POST",
+            headers={
+                'Accept': 'application/vnd.git-lfs+json; charset=utf-8'
+            },
+            body='{"operation": "upload", "objects": [{"oid": "a", "size": 1}], "transfers": ["unknown"]}'
+        )
+
+        actual = self.batch_facade.process(http_request)
+
+        with self.assertRaisesRegex(expected_exception=HttpError, expected_regex='Unprocessable Entity'):
+            list(actual.body.iter_json())
+
+    def test_process_multipart_transfers_after_objects(self):
+        self.batch_facade = BatchFacade(self.mock_lfs, streaming=True, window_size=2, part_size=100)
+        self.mock_lfs.exists_many.return_value = set()
+        self.mock_lfs.prepare_multipart_upload.return_value = MultipartUpload(
+            parts=[BatchResponse.ObjectLfs.Action('url/1', pos=0, size=100)],
+            commit=BatchResponse.ObjectLfs.Action('url/commit')
+        )
+        http_request = HttpRequest(
+            '/objects/batch', "POST",
+            headers={
+                'Accept': 'application/vnd.git-lfs+json; charset=utf-8'
+            },
+            body=f'{{"operation": "upload", "objects": [{{"oid": "{OID}", "size": 100}}], '
+                 f'"transfers": ["basic", "multipart"]}}'
+        )
+
+        actual = self.batch_facade.process(http_request)
+
+        self.assertEqual(actual.body.transfer, 'multipart')
+        objects = list(actual.body.objects)
+        self.assertEqual(objects[0].actions['commit'].href, 'url/commit')
+        self.mock_lfs.prepare_multipart_upload.assert_called_once_with(OID, 100, 100)
+        self.mock_lfs.prepare_upload.assert_not_called()
+
+    def test_iter_json(self):
+        self.mock_lfs.prepare_upload.side_effect = lambda oid, size: BatchResponse.ObjectLfs.Action(f'url/{oid}')
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(f'{i:064x}', i) for i in range(50)])
+        expected = BatchFacade(self.mock_lfs).batch_request(batch_request).as_json()
+
+        actual = list(self.batch_facade.batch_request(batch_request).iter_json(chunk_size=100))
+
+        self.assertGreater(len(actual), 2)
+        self.assertEqual(actual[0], '{"transfer": "basic", "objects": [')
+        self.assertEqual(''.join(actual), expected)
+
+    def test_as_dict(self):
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        batch_request = BatchRequest('upload', [BatchRequest.ObjectLfs(OID, 1)])
+
+        actual = self.batch_facade.batch_request(batch_request).as_dict()
+
+        self.assertEqual(actual, {
+            'transfer': 'basic',
+            'objects': [{'oid': OID, 'size': 1, 'authenticated': True, 'actions': {'upload': {'href': 'url'}}}]
+        })
+
+
+class BatchRequestReaderTestCase(unittest.TestCase):
+
+    def test_read(self):
+        with open('resources/batch_request.json', 'rb') as f:
+            body = f.read()
+
+        actual = BatchRequestReader(body[i:i + 1] for i in range(len(body))).read()
+
+        self.assertEqual(actual.operation, 'download')
+        self.assertEqual(actual.transfers, ['basic'])
+        self.assertEqual(actual.ref.name, 'refs/heads/master')
+        self.assertEqual(list(actual.objects), [BatchRequest.ObjectLfs('12345678', 123)])
+
+    def test_read_trailing_fields(self):
+        body = '{"operation": "upload", "objects": [{"oid": "a", "size": 1}, {"oid": "b", "size": 2}], ' \
+               '"transfers": ["multipart", "basic"], "ref": {"name": "refs/heads/\u00e9t\u00e9"}}'
+
+        actual = BatchRequestReader([body[:40], body[40:]]).read()
+
+        self.assertEqual(actual.operation, 'upload')
+        self.assertEqual(actual.transfers, ['basic'])
+        self.assertEqual([obj.oid for obj in actual.objects], ['a', 'b'])
+        self.assertEqual(actual.transfers, ['multipart', 'basic'])
+        self.assertEqual(actual.ref.name, 'refs/heads/\u00e9t\u00e9')
+
+    def test_read_objects_before_operation(self):
+        body = '{"objects": [], "operation": "download"}'
+
+        actual = BatchRequestReader(body).read()
+
+        self.assertEqual(actual.operation, 'download')
+        self.assertEqual(actual.objects, [])
+
+    def test_read_multibyte_chunks(self):
+        body = '{"operation": "download", "ref": {"name": "\u0432\u0435\u0442\u043a\u0430"}, "objects": []}'
+        encoded = body.encode()
+
+        actual = BatchRequestReader(encoded[i:i + 1] for i in range(len(encoded))).read()
+
+        self.assertEqual(actual.ref.name, '\u0432\u0435\u0442\u043a\u0430')
+        self.assertEqual(list(actual.objects), [])
+
+    def test_read_invalid(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(BatchRequestReader('{"operation": "download", "objects": [{"oid": "a", "size": 1} {').read().objects)
+
+        with self.assertRaises(json.JSONDecodeError):
+            BatchRequestReader('{"operation": "download"').read()
+
+        with self.assertRaises(KeyError):
+            BatchRequestReader('{"operation": "download"}').read()
+
+
+class KeyInsensitiveDictTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dictionary = KeyInsensitiveDict(
+            {
+                'Foo': 'bar'
+            }
+        )
+
+    def test_getitem(self):
+        actual = self.dictionary['Foo']
+
+        self.assertEqual(actual, 'bar')
+
+    def test_get(self):
+        actual = self.dictionary.get('Foo')
+
+        self.assertEqual(actual, 'bar')
+
+    def test_get_missing_value(self):
+        actual = self.dictionary.get('baz')
+
+        self.assertIsNone(actual)
+
+    def test_contains(self):
+        self.assertIn('FOO', self.dictionary)
+        self.assertNotIn('baz', self.dictionary)
+
+
+class RegistryTestCase(unittest.TestCase):
+
+    def test_get(self):
+        registry = Registry()
+        factory = mock.MagicMock()
+        factory.side_effect = lambda: object()
+
+        actual = registry.get('lfs', factory)
+
+        self.assertIs(registry.get('lfs', factory), actual)
+        factory.assert_called_once()
+
+    def test_get_concurrently(self):
+        registry = Registry()
+        factory = mock.MagicMock()
+        factory.side_effect = lambda: time.sleep(0.01) or object()
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            actual = list(executor.map(lambda _: registry.get('lfs', factory), range(16)))
+
+        self.assertEqual(len(set(map(id, actual))), 1)
+        factory.assert_called_once()
+
+    def test_get_nested(self):
+        registry = Registry()
+
+        actual = registry.get('facade', lambda: ('facade', registry.get('lfs', lambda: 'lfs')))
+
+        self.assertEqual(actual, ('facade', 'lfs'))
+        self.assertEqual(registry.get('lfs', lambda: 'other'), 'lfs')
+
+    def test_reset(self):
+        registry = Registry()
+        registry.get('lfs', lambda: 'foo')
+        registry.get('client', lambda: 'bar')
+
+        registry.reset('lfs')
+
+        self.assertEqual(registry.get('lfs', lambda: 'baz'), 'baz')
+        self.assertEqual(registry.get('client', lambda: 'baz'), 'bar')
+        registry.reset()
+        self.assertEqual(registry.instances, {})
+
+
+class KeyLayoutTestCase(unittest.TestCase):
+
+    def test_flat(self):
+        layout = KeyLayout.create('flat', legacy=KeyLayout())
+
+        self.assertEqual(layout.key('1bf0e3fc785fde'), '1bf0e3fc785fde')
+        self.assertEqual(layout.keys('1bf0e3fc785fde'), ['1bf0e3fc785fde'])
+
+    def test_sharded(self):
+        layout = KeyLayout.create('sharded')
+
+        self.assertEqual(layout.key('1bf0e3fc785fde'), '1b/f0/1bf0e3fc785fde')
+        self.assertEqual(layout.keys('1bf0e3fc785fde'), ['1b/f0/1bf0e3fc785fde'])
+
+    def test_prefixed(self):
+        layout = KeyLayout.create('prefixed', prefix='/org/repo/')
+
+        self.assertEqual(layout.key('1bf0e3fc785fde'), 'org/repo/1b/f0/1bf0e3fc785fde')
+
+    def test_unknown(self):
+        with self.assertRaisesRegex(expected_exception=ValueError, expected_regex='Unknown key layout: foo'):
+            KeyLayout.create('foo')
+
+    def test_locate_legacy_fallback(self):
+        layout = ShardedKeyLayout(legacy=KeyLayout())
+        exists = mock.MagicMock()
+        exists.side_effect = lambda key: key == '1bf0e3fc785fde'
+
+        self.assertEqual(layout.keys('1bf0e3fc785fde'), ['1b/f0/1bf0e3fc785fde', '1bf0e3fc785fde'])
+        self.assertEqual(layout.locate('1bf0e3fc785fde', exists), '1bf0e3fc785fde')
+        exists.side_effect = lambda key: False
+        self.assertEqual(layout.locate('1bf0e3fc785fde', exists), '1b/f0/1bf0e3fc785fde')
+
+    def test_locate_without_fallback(self):
+        exists = mock.MagicMock()
+
+        self.assertEqual(ShardedKeyLayout().locate('1bf0e3fc785fde', exists), '1b/f0/1bf0e3fc785fde')
+        exists.assert_not_called()
+
+    def test_locate_matched(self):
+        layout = ShardedKeyLayout(legacy=KeyLayout(), max_located=1)
+        exists = mock.MagicMock()
+        exists.return_value = False
+
+        self.assertEqual(layout.match('1bf0e3fc785fde', {'1bf0e3fc785fde'}), '1bf0e3fc785fde')
+        self.assertEqual(layout.locate('1bf0e3fc785fde', exists), '1bf0e3fc785fde')
+        exists.assert_not_called()
+        self.assertIsNone(layout.match('1bf0e3fc785fde', set()))
+        self.assertEqual(layout.locate('1bf0e3fc785fde', exists), '1b/f0/1bf0e3fc785fde')
+        exists.side_effect = lambda key: key == '2c/0e/2c0e7a4d9b1f3a'
+        self.assertEqual(layout.find('2c0e7a4d9b1f3a', exists), '2c/0e/2c0e7a4d9b1f3a')
+        self.assertEqual(list(layout.located), ['2c0e7a4d9b1f3a'])
+
+
+class LargeFileStorageTestCase(unittest.TestCase):
+
+    def test_exists_many(self):
+        lfs = LargeFileStorage()
+        lfs.exists = mock.MagicMock()
+        lfs.exists.side_effect = lambda oid: oid != 'MkP0NjI9BhU8'
+
+        actual = lfs.exists_many(['QaX1WsC2EdC3', 'MkP0NjI9BhU8'])
+
+        self.assertEqual(actual, {'QaX1WsC2EdC3'})
+        self.assertEqual(lfs.exists.call_count, 2)
+
+    def test_sizes_many(self):
+        lfs = LargeFileStorage()
+        lfs.size = mock.MagicMock()
+        lfs.size.side_effect = lambda oid: None if oid == 'MkP0NjI9BhU8' else 123
+
+        actual = lfs.sizes_many(['QaX1WsC2EdC3', 'MkP0NjI9BhU8'])
+
+        self.assertEqual(actual, {'QaX1WsC2EdC3': 123})
+        self.assertIsNone(LargeFileStorage().size('QaX1WsC2EdC3'))
+
+    def test_prepare_multipart_upload(self):
+        lfs = LargeFileStorage()
+        lfs.prepare_upload = mock.MagicMock()
+        lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url', expires_in=60)
+
+        actual = lfs.prepare_multipart_upload('QaX1WsC2EdC3', 123, 10)
+
+        self.assertEqual(actual.parts, [BatchResponse.ObjectLfs.Action('url', expires_in=60, pos=0, size=123)])
+        self.assertIsNone(actual.commit)
+        lfs.prepare_upload.assert_called_once_with('QaX1WsC2EdC3', 123)
+
+
+class AsyncLargeFileStorageTestCase(unittest.TestCase):
+
+    def test_exists_many(self):
+        class Storage(AsyncLargeFileStorage):
+            async def exists(self, oid: str) -> bool:
+                return oid != 'MkP0NjI9BhU8'
+
+        actual = asyncio.run(Storage().exists_many(['QaX1WsC2EdC3', 'MkP0NjI9BhU8']))
+
+        self.assertEqual(actual, {'QaX1WsC2EdC3'})
+
+
+class ExistenceCacheTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.now = 100.0
+        self.cache = ExistenceCache(max_size=2, negative_ttl=5, max_negative_size=2, clock=lambda: self.now)
+
+    def test_positive_lru(self):
+        self.cache.put('a', True)
+        self.cache.put('b', True)
+        self.assertTrue(self.cache.get('a'))
+        self.cache.put('c', True)
+
+        self.assertTrue(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertTrue(self.cache.get('c'))
+        self.assertEqual(self.cache.stats(), {'hits': 3, 'misses': 1, 'positive_size': 2, 'negative_size': 0})
+
+    def test_negative_ttl(self):
+        self.cache.put('a', False)
+
+        self.assertFalse(self.cache.get('a'))
+        self.now += 5
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['negative_size'], 0)
+
+    def test_negative_replaced_by_positive(self):
+        self.cache.put('a', False)
+        self.cache.put('a', True)
+
+        self.assertTrue(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['negative_size'], 0)
+
+    def test_negative_disabled(self):
+        cache = ExistenceCache(max_size=10)
+        cache.put('a', False)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.enabled)
+        self.assertFalse(ExistenceCache().enabled)
+
+
+class CachingLargeFileStorageTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_lfs = mock.MagicMock()
+        self.cache = ExistenceCache(max_size=10, negative_ttl=60)
+        self.lfs = CachingLargeFileStorage(self.mock_lfs, self.cache)
+
+    def test_exists(self):
+        self.mock_lfs.exists.return_value = True
+
+        self.assertTrue(self.lfs.exists('a'))
+        self.assertTrue(self.lfs.exists('a'))
+        self.mock_lfs.exists.assert_called_once_with('a')
+
+    def test_exists_many(self):
+        self.mock_lfs.exists_many.return_value = {'a'}
+        self.assertEqual(self.lfs.exists_many(['a', 'b']), {'a'})
+        self.mock_lfs.exists_many.return_value = {'c'}
+
+        actual = self.lfs.exists_many(['a', 'b', 'c'])
+
+        self.assertEqual(actual, {'a', 'c'})
+        self.mock_lfs.exists_many.assert_called_with(['c'])
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    def test_sizes_many(self):
+        self.mock_lfs.sizes_many.return_value = {'a': 1}
+
+        self.assertEqual(self.lfs.sizes_many(['a', 'b']), {'a': 1})
+        self.assertTrue(self.lfs.exists('a'))
+        self.mock_lfs.exists.assert_not_called()
+
+    def test_size_clears_negative(self):
+        self.mock_lfs.exists.return_value = False
+        self.assertFalse(self.lfs.exists(OID))
+        self.mock_lfs.size.return_value = 1
+
+        facade = VerifyFacade(self.lfs)
+        facade.verify(VerifyRequest(OID, 1))
+
+        self.assertTrue(self.lfs.exists(OID))
+        self.mock_lfs.exists.assert_called_once_with(OID)
+
+    def test_exists_many_all_cached(self):
+        self.cache.put('a', True)
+
+        self.assertEqual(self.lfs.exists_many(['a']), {'a'})
+        self.mock_lfs.exists_many.assert_not_called()
+
+    def test_delegates(self):
+        self.mock_lfs.prepare_download.return_value = 'download'
+        self.mock_lfs.download.return_value = 'content'
+
+        self.assertEqual(self.lfs.prepare_download('a', 1), 'download')
+        self.assertEqual(self.lfs.download('a'), 'content')
+
+
+class PresignCachingLargeFileStorageTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.now = 1478791747.0
+        self.mock_lfs = mock.MagicMock()
+        self.cache = PresignCache(max_size=2, min_lifetime=600, clock=lambda: self.now)
+        self.lfs = PresignCachingLargeFileStorage(self.mock_lfs, self.cache, expires_in=3600)
+
+    def test_prepare_download(self):
+        self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url', header={'Key': 'value'})
+
+        first = self.lfs.prepare_download('a', 1)
+        self.now += 1000
+        second = self.lfs.prepare_download('a', 1)
+
+        self.mock_lfs.prepare_download.assert_called_once_with('a', 1)
+        self.assertEqual(first.href, 'url')
+        self.assertEqual(first.header, {'Key': 'value'})
+        self.assertEqual(first.expires_in, 3600)
+        self.assertEqual(first.expires_at, '2016-11-10T16:29:07+00:00')
+        self.assertEqual(second.href, 'url')
+        self.assertEqual(second.expires_in, 2600)
+        self.assertEqual(second.expires_at, '2016-11-10T16:29:07+00:00')
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_prepare_min_lifetime(self):
+        self.mock_lfs.prepare_upload.side_effect = [
+            BatchResponse.ObjectLfs.Action('url1'),
+            BatchResponse.ObjectLfs.Action('url2')
+        ]
+
+        self.lfs.prepare_upload('a', 1)
+        self.now += 3001
+        actual = self.lfs.prepare_upload('a', 1)
+
+        self.assertEqual(actual.href, 'url2')
+        self.assertEqual(actual.expires_in, 3600)
+        self.assertEqual(self.mock_lfs.prepare_upload.call_count, 2)
+
+    def test_prepare_keyed_by_operation(self):
+        self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('download')
+        self.mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('upload')
+
+        self.assertEqual(self.lfs.prepare_download('a', 1).href, 'download')
+        self.assertEqual(self.lfs.prepare_upload('a', 1).href, 'upload')
+
+    def test_prepare_expires_at(self):
+        self.mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action(
+            'url', expires_at='2016-11-10T15:29:07+00:00')
+
+        actual = self.lfs.prepare_download('a', 1)
+
+        self.assertEqual(actual.expires_in, 0)
+        self.assertEqual(self.lfs.prepare_download('a', 1).expires_at, '2016-11-10T15:29:07+00:00')
+        self.assertEqual(self.mock_lfs.prepare_download.call_count, 2)
+
+    def test_lru(self):
+        self.mock_lfs.prepare_download.side_effect = lambda oid, size: BatchResponse.ObjectLfs.Action(oid)
+
+        for oid in ['a', 'b', 'c', 'a']:
+            self.lfs.prepare_download(oid, 1)
+
+        self.assertEqual(self.mock_lfs.prepare_download.call_count, 4)
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+
+class InstrumentationTestCase(unittest.TestCase):
+
+    def test_noop(self):
+        instrumentation = Instrumentation()
+
+        with instrumentation.measure('parse', 1) as measurement:
+            measurement.errors = 1
+
+        self.assertIs(instrumentation.measure('parse'), instrumentation.measure('exists'))
+
+    def test_measure(self):
+        instrumentation = Instrumentation()
+        instrumentation.record = mock.MagicMock()
+
+        with self.assertRaises(ValueError):
+            with Measurement(instrumentation, 'parse', 3):
+                raise ValueError()
+
+        phase, duration, count, errors = instrumentation.record.call_args[0]
+        self.assertEqual((phase, count, errors), ('parse', 3, 1))
+        self.assertGreaterEqual(duration, 0)
+
+    def test_logging_instrumentation(self):
+        logger = mock.MagicMock()
+        instrumentation = LoggingInstrumentation(logger)
+
+        instrumentation.record('exists', 0.5, 10, 0)
+        instrumentation.record('exists', 0.25, 5, 1)
+        instrumentation.flush()
+        instrumentation.flush()
+
+        logger.log.assert_called_once()
+        level, message, metrics = logger.log.call_args[0]
+        self.assertEqual(message, 'Metrics: %s')
+        self.assertEqual(json.loads(metrics), {'exists': {'calls': 2, 'duration': 0.75, 'count': 15, 'errors': 1}})
+
+    def test_summary_instrumentation(self):
+        logger = mock.MagicMock()
+        instrumentation = SummaryInstrumentation(logger)
+
+        instrumentation.annotate(operation='upload', objects=3)
+        instrumentation.annotate(status=200)
+        instrumentation.flush()
+        instrumentation.flush()
+
+        logger.log.assert_called_once()
+        level, message, fields = logger.log.call_args[0]
+        self.assertEqual((level, message), (logging.INFO, 'Summary: %s'))
+        self.assertEqual(json.loads(str(fields)), {'operation': 'upload', 'objects': 3, 'status': 200})
+        self.assertIs(instrumentation.measure('exists'), instrumentation.measure('prepare'))
+
+    def test_lazy_json(self):
+        logger = logging.getLogger('lazy_json')
+        logger.setLevel(logging.INFO)
+
+        with mock.patch('core.json.dumps') as mock_dumps:
+            logger.debug('Payload: %s', LazyJson({'oid': OID}))
+
+        mock_dumps.assert_not_called()
+
+        self.assertEqual(str(LazyJson({'oid': OID, 'size': 1})), json.dumps({'oid': OID, 'size': 1}))
+
+    def test_payload_log_level(self):
+        self.assertEqual(payload_log_level(0, lambda: 0.0), logging.DEBUG)
+        self.assertEqual(payload_log_level(0.1, lambda: 0.05), logging.INFO)
+        self.assertEqual(payload_log_level(0.1, lambda: 0.5), logging.DEBUG)
+
+    def test_batch_facade_summary(self):
+        instrumentation = SummaryInstrumentation(mock.MagicMock())
+        mock_lfs = mock.MagicMock()
+        mock_lfs.exists_many.return_value = {OID}
+        mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
+        facade = BatchFacade(mock_lfs, window_size=2, instrumentation=instrumentation)
+
+        facade.process(HttpRequest(
+            '/objects/batch', "POST",
+            headers={
+                'Accept': 'application/vnd.git-lfs+json'
+            },
+            body=json.dumps({
+                'operation': 'download',
+                'objects': [{'oid': oid, 'size': 1} for oid in (OID, OTHER_OID, MISSING_OID)]
+            })
+        ))
+
+        self.assertIs(facade.lfs, mock_lfs)
+        self.assertEqual(instrumentation.fields, {'operation': 'download', 'transfer': 'basic', 'objects': 3})
+
+    def test_batch_facade(self):
+        instrumentation = LoggingInstrumentation(mock.MagicMock())
+        mock_lfs = mock.MagicMock()
+        mock_lfs.exists_many.return_value = {OID}
+        mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
+        facade = BatchFacade(mock_lfs, window_size=2, instrumentation=instrumentation)
+        http_request = HttpRequest(
+            '/objects/batch', "POST",
+            headers={
+                'Accept': 'application/vnd.git-lfs+json'
+            },
+            body=json.dumps({
+                'operation': 'download',
+                'objects': [{'oid': oid, 'size': 1} for oid in (OID, OTHER_OID, MISSING_OID)]
+            })
+        )
+
+        facade.process(http_request)
+
+        metrics = instrumentation.metrics
+        self.assertEqual(metrics['parse']['calls'], 1)
+        self.assertEqual((metrics['exists']['calls'], metrics['exists']['count']), (2, 3))
+        self.assertEqual((metrics['prepare']['count'], metrics['prepare']['errors']), (3, 2))
+        self.assertEqual(metrics['storage.exists_many']['calls'], 2)
+        self.assertEqual(metrics['storage.prepare_download']['calls'], 1)
+        self.assertNotIn('storage.prepare_upload', metrics)
+
+
+class ResponseCompressorTestCase(unittest.TestCase):
+
+    def test_negotiate(self):
+        compressor = ResponseCompressor(encodings=('gzip',))
+
+        self.assertEqual(compressor.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compressor.negotiate('deflate, GZIP;q=0.5'), 'gzip')
+        self.assertEqual(compressor.negotiate('*'), 'gzip')
+        self.assertIsNone(compressor.negotiate('*, gzip;q=0'))
+        self.assertIsNone(compressor.negotiate('gzip;q=x'))
+        self.assertIsNone(compressor.negotiate('identity'))
+        self.assertIsNone(compressor.negotiate(None))
+
+    def test_negotiate_optional_encodings(self):
+        with mock.patch('core.brotli', None), mock.patch('core.zstandard', None):
+            self.assertEqual(ResponseCompressor().encodings, ('gzip',))
+            self.assertEqual(ResponseCompressor().negotiate('br, zstd, gzip'), 'gzip')
+
+        with mock.patch('core.brotli', mock.MagicMock()), mock.patch('core.zstandard', None):
+            self.assertEqual(ResponseCompressor().encodings, ('br', 'gzip'))
+            self.assertEqual(ResponseCompressor().negotiate('gzip, br'), 'br')
+
+    def test_compress(self):
+        compressor = ResponseCompressor(min_size=16, encodings=('gzip',))
+        body = json.dumps({'objects': [{'oid': OID, 'size': i} for i in range(100)]}).encode()
+
+        data, encoding = compressor.compress(body, 'gzip')
+
+        self.assertEqual(encoding, 'gzip')
+        self.assertLess(len(data), len(body))
+        self.assertEqual(gzip.decompress(data), body)
+        self.assertEqual(compressor.compress(b'{}', 'gzip'), (b'{}', None))
+        self.assertEqual(compressor.compress(body, 'identity'), (body, None))
+
+    def test_compress_iter(self):
+        compressor = ResponseCompressor(encodings=('gzip',))
+        chunks = ['{"objects": [', *(f'{{"oid": "{OID}", "size": {i}}}, ' for i in range(100)), '{}]}']
+
+        actual = b''.join(compressor.compress_iter(iter(chunks), 'gzip'))
+
+        self.assertEqual(gzip.decompress(actual), ''.join(chunks).encode())
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_membership(self):
+        oids = [hashlib.sha256(str(i).encode()).hexdigest() for i in range(20000)]
+        bloom = BloomFilter.for_capacity(10000, 0.01)
+        for oid in oids[:10000]:
+            bloom.add(oid)
+
+        self.assertTrue(all(oid in bloom for oid in oids[:10000]))
+        self.assertLess(sum(oid in bloom for oid in oids[10000:]), 200)
+
+    def test_bytes(self):
+        bloom = BloomFilter.for_capacity(100, 0.01)
+        bloom.add(OID)
+
+        actual = BloomFilter.from_bytes(bloom.to_bytes())
+
+        self.assertEqual((actual.size, actual.hashes, actual.bits), (bloom.size, bloom.hashes, bloom.bits))
+        self.assertIn(OID, actual)
+        with self.assertRaises(ValueError):
+            BloomFilter.from_bytes(b'foo')
+        with self.assertRaises(ValueError):
+            BloomFilter.from_bytes(bloom.to_bytes()[:-1])
+
+
+class OidIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.snapshot, self.version = None, 0
+        self.now = 0
+        self.load = mock.MagicMock(side_effect=lambda: (self.snapshot, str(self.version) if self.snapshot else None))
+        self.save = mock.MagicMock(side_effect=self.conditional_save)
+        self.executor = mock.MagicMock()
+        self.executor.submit.side_effect = lambda fn: fn()
+        self.index = OidIndex(self.load, self.save, scan=lambda: [OID], capacity=100, max_age=60,
+                              executor=self.executor, clock=lambda: self.now)
+
+    def conditional_save(self, data, etag):
+        if etag != (str(self.version) if self.snapshot else None):
+            return False
+        self.snapshot, self.version = data, self.version + 1
+        return True
+
+    def test_scan_missing_snapshot(self):
+        actual = self.index.maybe_present([OID, OTHER_OID])
+
+        self.assertEqual(actual, [OID])
+        self.save.assert_called_once_with(mock.ANY, None)
+        self.assertIn(OID, BloomFilter.from_bytes(self.snapshot))
+
+    def test_background_refresh(self):
+        self.executor.submit.side_effect = None
+
+        self.assertEqual(self.index.maybe_present([OID, OTHER_OID]), [OID, OTHER_OID])
+        self.assertEqual(self.index.maybe_present([OID, OTHER_OID]), [OID, OTHER_OID])
+        self.executor.submit.assert_called_once_with(self.index.refresh)
+        self.load.assert_not_called()
+
+        self.index.refresh()
+
+        self.assertEqual(self.index.maybe_present([OID, OTHER_OID]), [OID])
+
+    def test_without_snapshot(self):
+        index = OidIndex(lambda: (None, None), self.save, executor=self.executor)
+
+        self.assertEqual(index.maybe_present([OID, OTHER_OID]), [OID, OTHER_OID])
+        index.add([OID])
+        self.save.assert_not_called()
+
+    def test_add_published_on_refresh(self):
+        self.index.maybe_present([OID])
+        self.index.add([OTHER_OID])
+
+        self.assertEqual(self.index.maybe_present([OTHER_OID]), [OTHER_OID])
+        self.assertEqual((self.load.call_count, self.save.call_count), (1, 1))
+        self.assertNotIn(OTHER_OID, BloomFilter.from_bytes(self.snapshot))
+
+        other = BloomFilter.from_bytes(self.snapshot)
+        other.add(MISSING_OID)
+        self.snapshot, self.version = other.to_bytes(), self.version + 1
+        self.now = 60
+
+        self.assertEqual(self.index.maybe_present([OTHER_OID, MISSING_OID]), [OTHER_OID, MISSING_OID])
+        self.assertEqual((self.load.call_count, self.save.call_count), (2, 2))
+        self.assertIn(OTHER_OID, BloomFilter.from_bytes(self.snapshot))
+        self.assertIn(MISSING_OID, BloomFilter.from_bytes(self.snapshot))
+
+    def test_concurrent_publish(self):
+        self.index.maybe_present([OID])
+        self.index.add([OTHER_OID])
+        other = BloomFilter.from_bytes(self.snapshot)
+        other.add(MISSING_OID)
+        save = self.save.side_effect
+
+        def concurrent_save(data, etag):
+            self.snapshot, self.version = other.to_bytes(), self.version + 1
+            self.save.side_effect = save
+            return save(data, etag)
+
+        self.save.side_effect = concurrent_save
+        self.now = 60
+
+        self.index.maybe_present([OID])
+
+        self.assertEqual((self.load.call_count, self.save.call_count), (3, 3))
+        self.assertIn(OTHER_OID, BloomFilter.from_bytes(self.snapshot))
+        self.assertIn(MISSING_OID, BloomFilter.from_bytes(self.snapshot))
+        self.assertEqual(self.index.pending, set())
+
+    def test_load_error(self):
+        load = self.load.side_effect
+        self.load.side_effect = IOError('foo')
+
+        with self.assertLogs('core', 'WARNING'):
+            self.assertEqual(self.index.maybe_present([OID, OTHER_OID]), [OID, OTHER_OID])
+        self.index.add([OTHER_OID])
+
+        self.load.side_effect = load
+        self.now = 60
+        self.assertEqual(self.index.maybe_present([OTHER_OID, MISSING_OID]), [OTHER_OID])
+        self.assertIn(OTHER_OID, BloomFilter.from_bytes(self.snapshot))
+
+    def test_batch_facade_upload(self):
+        mock_lfs = mock.MagicMock()
+        mock_lfs.exists_many.return_value = {OID}
+        mock_lfs.prepare_upload.return_value = BatchResponse.ObjectLfs.Action('url')
+        facade = BatchFacade(mock_lfs, oid_index=self.index)
+
+        actual = facade.batch_request(BatchRequest('upload', objects=[
+            BatchRequest.ObjectLfs(OID, 1), BatchRequest.ObjectLfs(OTHER_OID, 2)
+        ]))
+
+        mock_lfs.exists_many.assert_called_once_with([OID])
+        self.assertEqual([obj.actions is not None for obj in actual.objects], [False, True])
+
+    def test_batch_facade_download(self):
+        mock_lfs = mock.MagicMock()
+        mock_lfs.exists_many.return_value = {OID, OTHER_OID}
+        mock_lfs.prepare_download.return_value = BatchResponse.ObjectLfs.Action('url')
+        facade = BatchFacade(mock_lfs, oid_index=self.index)
+
+        actual = facade.batch_request(BatchRequest('download', objects=[
+            BatchRequest.ObjectLfs(OID, 1), BatchRequest.ObjectLfs(OTHER_OID, 2)
+        ]))
+
+        mock_lfs.exists_many.assert_called_once_with([OID, OTHER_OID])
+        self.assertTrue(all(obj.error is None for obj in actual.objects))
+        self.assertEqual(self.index.maybe_present([OTHER_OID]), [OTHER_OID])
+
+    def test_async_batch_facade_download(self):
+        mock_lfs = mock.MagicMock()
+        mock_lfs.exists_many = mock.AsyncMock(return_value={OID})
+        mock_lfs.prepare_download = mock.AsyncMock(return_value=BatchResponse.ObjectLfs.Action('url'))
+        facade = AsyncBatchFacade(mock_lfs, oid_index=self.index)
+        self.index.maybe_present([])
+        add, threads = self.index.add, []
+        self.index.add = lambda oids: threads.append(threading.current_thread()) or add(oids)
+
+        asyncio.run(facade.batch_request(BatchRequest('download', objects=[BatchRequest.ObjectLfs(OID, 1)])))
+
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+
+    def test_invalid_oid(self):
+        self.index.maybe_present([])
+        self.index.add(['foo'])
+
+        self.assertEqual(self.index.maybe_present(['foo', OTHER_OID]), ['foo'])
+        self.assertEqual(self.index.pending, set())
+
+    def test_verify_facade(self):
+        mock_lfs = mock.MagicMock()
+        mock_lfs.size.return_value = 2
+        facade = VerifyFacade(mock_lfs, oid_index=self.index)
+
+        facade.verify(VerifyRequest(OTHER_OID, 2))
+
+        self.assertEqual(self.index.maybe_present([OTHER_OID]), [OTHER_OID])
@@ -2,9 +2,12 @@ import datetime
 import json
 import logging
 import os
+import time
 import uuid
+from typing import Iterator, Optional, Tuple
 
 import flask
+from google.api_core.exceptions import PreconditionFailed
 from google.cloud import storage
 
 from core import *
@@ -12,6 +15,18 @@ from core import *
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
+existence_cache = ExistenceCache(
+    max_size=int(os.getenv('EXISTS_CACHE_SIZE', '0')),
+    negative_ttl=float(os.getenv('EXISTS_CACHE_NEGATIVE_TTL', '0'))
+)
+
+presign_cache = PresignCache(
+    max_size=int(os.getenv('PRESIGN_CACHE_SIZE', '0')),
+    min_lifetime=float(os.getenv('PRESIGN_CACHE_MIN_LIFETIME', '900'))
+)
+
+registry = Registry()
+
 __all__ = (
     'GoogleCloudFileStorage',
     'Factory',
@@ -22,26 +37,59 @@ __all__ = (
 
 class GoogleCloudFileStorage(LargeFileStorage):
 
-    def __init__(self) -> None:
+    def __init__(self, layout: KeyLayout = None) -> None:
         storage_client = storage.Client()
         self.bucket = storage_client.bucket(os.getenv('BUCKET_NAME'))
+        self.layout = layout or KeyLayout()
 
     def exists(self, oid: str) -> bool:
-        blob = self.bucket.blob(oid)
+        return self.layout.find(oid, self.key_exists) is not None
+
+    def key_exists(self, key: str) -> bool:
+        blob = self.bucket.blob(key)
         return blob.exists()
 
+    def size(self, oid: str) -> Optional[int]:
+        keys = self.layout.keys(oid)
+        for key in keys:
+            blob = self.bucket.get_blob(key)
+            if blob is not None:
+                self.layout.remember(oid, keys, key)
+                return blob.size
+
+        self.layout.remember(oid, keys, None)
+        return None
+
+    def read_object(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        blob = self.bucket.get_blob(key)
+        if blob is None:
+            return None, None
+
+        return blob.download_as_bytes(if_generation_match=blob.generation), str(blob.generation)
+
+    def write_object(self, key: str, data: bytes, etag: Optional[str]) -> bool:
+        try:
+            self.bucket.blob(key).upload_from_string(data, if_generation_match=int(etag) if etag else 0)
+        except PreconditionFailed:
+            return False
+
+        return True
+
+    def iter_oids(self) -> Iterator[str]:
+        return oids_of(blob.name for blob in self.bucket.list_blobs())
+
     def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         return BatchResponse.ObjectLfs.Action(
-            href=self.presign('GET', oid)
+            href=self.presign('GET', self.layout.locate(oid, self.key_exists))
         )
 
     def prepare_upload(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         return BatchResponse.ObjectLfs.Action(
-            href=self.presign('PUT', oid)
+            href=self.presign('PUT', self.layout.key(oid))
         )
 
-    def presign(self, method: str, oid: str):
-        blob = self.bucket.blob(oid)
+    def presign(self, method: str, key: str):
+        blob = self.bucket.blob(key)
         return blob.generate_signed_url(
             version='v4',
             expiration=datetime.timedelta(minutes=60),
@@ -52,13 +100,103 @@ class GoogleCloudFileStorage(LargeFileStorage):
 class Factory:
 
     @staticmethod
-    def create_batch_facade():
-        return BatchFacade(GoogleCloudFileStorage())
+    def create_large_file_storage():
+        lfs = GoogleCloudFileStorage(Factory.create_key_layout())
+        if existence_cache.enabled:
+            lfs = CachingLargeFileStorage(lfs, existence_cache)
+        if presign_cache.enabled:
+            lfs = PresignCachingLargeFileStorage(lfs, presign_cache, expires_in=3600)
+        return lfs
+
+    @staticmethod
+    def large_file_storage():
+        return registry.get('large_file_storage', Factory.create_large_file_storage)
+
+    @staticmethod
+    def create_oid_index(lfs: LargeFileStorage):
+        if os.getenv('OID_INDEX', 'false').lower() != 'true':
+            return None
+
+        key = os.getenv('OID_INDEX_KEY', '.lfs/oids.bloom')
+        return OidIndex(
+            lambda: lfs.read_object(key),
+            lambda data, etag: lfs.write_object(key, data, etag),
+            scan=lfs.iter_oids,
+            capacity=int(os.getenv('OID_INDEX_CAPACITY', '1000000')),
+            error_rate=float(os.getenv('OID_INDEX_ERROR_RATE', '0.01')),
+            max_age=float(os.getenv('OID_INDEX_MAX_AGE', '60'))
+        )
+
+    @staticmethod
+    def oid_index():
+        lfs = Factory.large_file_storage()
+        return registry.get('oid_index', lambda: Factory.create_oid_index(lfs))
+
+    @staticmethod
+    def reset():
+        registry.reset()
+        existence_cache.clear()
+        presign_cache.clear()
+
+    @staticmethod
+    def create_key_layout():
+        return KeyLayout.create(
+            os.getenv('KEY_LAYOUT', 'flat'),
+            prefix=os.getenv('KEY_PREFIX', ''),
+            legacy=KeyLayout() if os.getenv('KEY_LEGACY_FALLBACK', 'true').lower() == 'true' else None
+        )
+
+    @staticmethod
+    def create_instrumentation():
+        if os.getenv('LOG_METRICS', 'false').lower() == 'true':
+            return LoggingInstrumentation(logger)
+        if os.getenv('LOG_SUMMARY', 'true').lower() == 'true':
+            return SummaryInstrumentation(logger)
+        return Instrumentation()
+
+    @staticmethod
+    def create_batch_facade(endpoint: str = None):
+        return BatchFacade(
+            Factory.large_file_storage(),
+            executor=shared_executor(int(os.getenv('BATCH_MAX_WORKERS', '0'))),
+            max_concurrency=int(os.getenv('BATCH_MAX_CONCURRENCY', '0')) or None,
+            instrumentation=Factory.create_instrumentation(),
+            skip_existing_uploads=os.getenv('SKIP_EXISTING_UPLOADS', 'true').lower() == 'true',
+            verify_upload_size=os.getenv('VERIFY_UPLOAD_SIZE', 'false').lower() == 'true',
+            verify_endpoint=Factory.create_verify_endpoint(endpoint),
+            part_size=int(os.getenv('MULTIPART_PART_SIZE', '0')) or None,
+            oid_index=Factory.oid_index()
+        )
+
+    @staticmethod
+    def create_response_compressor():
+        if os.getenv('COMPRESS_RESPONSES', 'true').lower() != 'true':
+            return None
+        return ResponseCompressor(min_size=int(os.getenv('COMPRESS_MIN_SIZE', '1024')))
+
+    @staticmethod
+    def create_verify_endpoint(endpoint: str = None):
+        if os.getenv('VERIFY_UPLOADS', 'true').lower() != 'true':
+            return None
+        return os.getenv('LFS_ENDPOINT', endpoint)
+
+    @staticmethod
+    def create_verify_facade():
+        return VerifyFacade(
+            Factory.large_file_storage(),
+            instrumentation=Factory.create_instrumentation(),
+            oid_index=Factory.oid_index()
+        )
 
 
 def process(request: flask.Request):
+    start = time.perf_counter()
+    facade, status, request_id = None, 500, str(uuid.uuid4())
     try:
-        facade = Factory.create_batch_facade()
+        if request.path == '/objects/verify':
+            facade = Factory.create_verify_facade()
+        else:
+            facade = Factory.create_batch_facade(request.url_root)
 
         response = facade.process(
             HttpRequest(
@@ -70,12 +208,29 @@ def process(request: flask.Request):
             )
         )
 
-        return dataclass_as_dict(response.body), response.status_code, response.headers
+        with facade.instrumentation.measure('serialize'):
+            body = dataclass_as_dict(response.body)
+
+        status = response.status_code
+        compressor = Factory.create_response_compressor()
+        accept_encoding = request.headers.get('Accept-Encoding')
+        if compressor is not None and compressor.negotiate(accept_encoding) is not None:
+            with facade.instrumentation.measure('compress'):
+                data, encoding = compressor.compress(json.dumps(body).encode(), accept_encoding)
+            if encoding is not None:
+                return flask.Response(
+                    data,
+                    status=response.status_code,
+                    headers={**response.headers, **ResponseCompressor.headers(encoding)}
+                )
+
+        return body, response.status_code, response.headers
 
     except HttpError as e:
+        status = e.code
         response = {
             'message': e.message,
-            'request_id': str(uuid.uuid4())
+            'request_id': request_id
         }
 
         return response, e.code
@@ -84,14 +239,24 @@ def process(request: flask.Request):
         logger.error(e, exc_info=True)
         response = {
             'message': 'Internal Server Error',
-            'request_id': str(uuid.uuid4())
+            'request_id': request_id
         }
 
         return response, 500
 
+    finally:
+        if facade is not None:
+            facade.instrumentation.annotate(
+                status=status,
+                duration=round(time.perf_counter() - start, 6),
+                request_id=request_id
+            )
+            facade.instrumentation.flush()
+
 
 def function_handler(req: flask.Request):
-    logger.info(f'Request: method={req.method}, path={req.full_path}, body={req.json}')
+    level = payload_log_level(float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', '0')))
+    logger.log(level, 'Request: method=%s, path=%s, body=%s', req.method, req.full_path, LazyJson(req.json))
     response = process(req)
-    logger.info('Response: %s' % json.dumps(response))
+    logger.log(level, 'Response: %s', LazyJson(response))
     return response
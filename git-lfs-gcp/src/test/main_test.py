@@ -1,8 +1,13 @@
 import datetime
+import gzip
+import hashlib
+import json
 import unittest
 from unittest import mock
 
-from core import HttpResponse, BatchResponse, HttpError
+from google.api_core.exceptions import PreconditionFailed
+
+from core import HttpResponse, BatchResponse, HttpError, VerifyRequest, KeyLayout
 from main import *
 
 
@@ -69,6 +74,49 @@ class GoogleCloudFileStorageTestCase(unittest.TestCase):
         self.assertEqual(actual.href, 'http://examplebucket/happyface.jpg?action=put_object')
         self.lfs.presign.assert_called_once_with('PUT', 'happyface.jpg')
 
+    def test_oid_index_storage(self):
+        self.bucket_mock.get_blob.return_value = None
+        self.assertEqual(self.lfs.read_object('.lfs/oids.bloom'), (None, None))
+
+        self.bucket_mock.get_blob.return_value = self.blob_mock
+        self.blob_mock.generation = 7
+        self.blob_mock.download_as_bytes.return_value = b'foo'
+        self.assertEqual(self.lfs.read_object('.lfs/oids.bloom'), (b'foo', '7'))
+        self.blob_mock.download_as_bytes.assert_called_once_with(if_generation_match=7)
+
+        self.assertTrue(self.lfs.write_object('.lfs/oids.bloom', b'foo', None))
+        self.blob_mock.upload_from_string.assert_called_with(b'foo', if_generation_match=0)
+        self.blob_mock.upload_from_string.side_effect = PreconditionFailed('foo')
+        self.assertFalse(self.lfs.write_object('.lfs/oids.bloom', b'foo', '7'))
+        self.blob_mock.upload_from_string.assert_called_with(b'foo', if_generation_match=7)
+
+        oid = hashlib.sha256(b'foo').hexdigest()
+        self.bucket_mock.list_blobs.return_value = [mock.MagicMock(), mock.MagicMock()]
+        self.bucket_mock.list_blobs.return_value[0].name = oid
+        self.bucket_mock.list_blobs.return_value[1].name = '.lfs/oids.bloom'
+        self.assertEqual(list(self.lfs.iter_oids()), [oid])
+
+    def test_prefixed_layout(self):
+        self.lfs.layout = KeyLayout.create('prefixed', prefix='repo', legacy=KeyLayout())
+        self.lfs.presign = mock.MagicMock()
+        self.blob_mock.exists.return_value = False
+
+        self.assertFalse(self.lfs.exists('1bf0e3fc785fde'))
+        self.assertEqual(
+            [c[0][0] for c in self.bucket_mock.blob.call_args_list], ['repo/1b/f0/1bf0e3fc785fde', '1bf0e3fc785fde'])
+        self.lfs.prepare_upload('1bf0e3fc785fde', 123)
+        self.lfs.presign.assert_called_once_with('PUT', 'repo/1b/f0/1bf0e3fc785fde')
+
+    def test_prefixed_layout_located(self):
+        self.lfs.layout = KeyLayout.create('prefixed', prefix='repo', legacy=KeyLayout())
+        self.lfs.presign = mock.MagicMock()
+        self.blob_mock.exists.side_effect = [False, True]
+
+        self.assertTrue(self.lfs.exists('1bf0e3fc785fde'))
+        self.lfs.prepare_download('1bf0e3fc785fde', 123)
+        self.lfs.presign.assert_called_once_with('GET', '1bf0e3fc785fde')
+        self.assertEqual(self.blob_mock.exists.call_count, 2)
+
 
 class FunctionTestCase(unittest.TestCase):
 
@@ -90,6 +138,19 @@ class FunctionTestCase(unittest.TestCase):
             self.assertEqual(actual[0], {'objects': [], 'transfer': 'foo'})
             self.assertEqual(actual[1], 200)
 
+    def test_process_compressed(self):
+        self.mock_request.headers = {'Accept-Encoding': 'gzip'}
+        objects = [BatchResponse.ObjectLfs(f'{i:064x}', i) for i in range(100)]
+        with mock.patch('main.Factory.create_batch_facade') as mock_factory:
+            mock_factory.return_value = self.mock_facade
+            self.mock_facade.process.return_value = HttpResponse(BatchResponse('basic', objects))
+
+            actual = process(self.mock_request)
+
+            self.assertEqual(actual.status_code, 200)
+            self.assertEqual(actual.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(len(json.loads(gzip.decompress(actual.get_data()))['objects']), 100)
+
     def test_process_http_error(self):
         with mock.patch('main.Factory.create_batch_facade') as mock_factory, \
                 mock.patch('uuid.uuid4') as mock_uuid:
@@ -115,3 +176,14 @@ class FunctionTestCase(unittest.TestCase):
             self.assertIsNotNone(actual)
             self.assertEqual(actual[0], {'message': 'Internal Server Error', 'request_id': 'uuid'})
             self.assertEqual(actual[1], 500)
+
+    def test_process_verify(self):
+        self.mock_request.path = '/objects/verify'
+        with mock.patch('main.Factory.create_verify_facade') as mock_factory:
+            mock_factory.return_value = self.mock_facade
+            self.mock_facade.process.return_value = HttpResponse(VerifyRequest('foo', 123))
+
+            actual = process(self.mock_request)
+
+            self.assertEqual(actual[0], {'oid': 'foo', 'size': 123})
+            self.assertEqual(actual[1], 200)
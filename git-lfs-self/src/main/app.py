@@ -1,7 +1,10 @@
 import argparse
 import json
+import os
+import threading
 import uuid
 from pathlib import Path
+from typing import Iterator, Optional, Tuple
 
 import flask
 from flask import request
@@ -17,15 +20,23 @@ __all__ = (
 
 
 class SimpleLargeFileStorage(LargeFileStorage):
+    lock = threading.Lock()
 
-    def __init__(self, repo: Path, endpoint: str):
+    def __init__(self, repo: Path, endpoint: str, layout: KeyLayout = None):
         self.repo = repo
         self.endpoint = endpoint
+        self.layout = layout or ShardedKeyLayout()
 
     def exists(self, oid: str) -> bool:
         oid_path = self.path(oid)
         return oid_path.exists()
 
+    def size(self, oid: str) -> Optional[int]:
+        try:
+            return self.path(oid).stat().st_size
+        except FileNotFoundError:
+            return None
+
     def prepare_download(self, oid: str, size: int) -> BatchResponse.ObjectLfs.Action:
         return self.prepare(oid)
 
@@ -37,42 +48,113 @@ class SimpleLargeFileStorage(LargeFileStorage):
         return self.prepare(oid)
 
     def upload(self, oid: str):
-        def mkdir(p):
-            try:
-                p.mkdir()
-            except FileExistsError:
-                pass
-
-        oid_path = self.path(oid)
-        mkdir(oid_path.parent.parent)
-        mkdir(oid_path.parent)
+        oid_path = self.repo / self.layout.key(oid)
+        oid_path.parent.mkdir(parents=True, exist_ok=True)
 
         with open(oid_path, "wb") as f:
             for chunk in wsgi.FileWrapper(request.stream):
                 f.write(chunk)
 
+    def read_object(self, key: str) -> Tuple[Optional[bytes], Optional[str]]:
+        with SimpleLargeFileStorage.lock:
+            try:
+                return (self.repo / key).read_bytes(), self.etag(self.repo / key)
+            except FileNotFoundError:
+                return None, None
+
+    def write_object(self, key: str, data: bytes, etag: Optional[str]) -> bool:
+        path = self.repo / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with SimpleLargeFileStorage.lock:
+            if self.etag(path) != etag:
+                return False
+
+            temp = path.with_name(f'.{path.name}.{uuid.uuid4().hex}')
+            temp.write_bytes(data)
+            os.replace(temp, path)
+            return True
+
+    def iter_oids(self) -> Iterator[str]:
+        return oids_of(str(path) for path in self.repo.rglob('*') if path.is_file())
+
+    @staticmethod
+    def etag(path: Path) -> Optional[str]:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+
     def prepare(self, oid: str) -> BatchResponse.ObjectLfs.Action:
         return BatchResponse.ObjectLfs.Action(
             href=f'{self.endpoint}transfer/{oid}'
         )
 
     def path(self, oid):
-        return self.repo / oid[:2] / oid[2:4] / oid
+        return self.repo / self.layout.locate(oid, lambda key: (self.repo / key).exists())
 
 
 class Factory:
+    existence_cache = ExistenceCache()
+    response_compressor: Optional[ResponseCompressor] = ResponseCompressor()
+    oid_index: Optional[OidIndex] = None
+
+    @staticmethod
+    def create_endpoint():
+        return args.endpoint if args.endpoint else request.url_root
 
     @staticmethod
     def create_large_file_storage():
-        return SimpleLargeFileStorage(
+        lfs = SimpleLargeFileStorage(
             repo=Path(args.repo),
-            endpoint=args.endpoint if args.endpoint else request.url_root
+            endpoint=Factory.create_endpoint(),
+            layout=Factory.create_key_layout()
+        )
+
+        if Factory.existence_cache.enabled:
+            lfs = CachingLargeFileStorage(lfs, Factory.existence_cache)
+        return lfs
+
+    @staticmethod
+    def create_key_layout():
+        return KeyLayout.create(
+            args.key_layout,
+            prefix=args.key_prefix,
+            legacy=ShardedKeyLayout() if args.key_layout != 'sharded' else None
+        )
+
+    @staticmethod
+    def create_oid_index():
+        lfs = SimpleLargeFileStorage(Path(args.repo), None, Factory.create_key_layout())
+        return OidIndex(
+            lambda: lfs.read_object(args.oid_index_path),
+            lambda data, etag: lfs.write_object(args.oid_index_path, data, etag),
+            scan=lfs.iter_oids,
+            capacity=args.oid_index_capacity
         )
 
     @staticmethod
     def create_batch_facade():
         return BatchFacade(
-            Factory.create_large_file_storage()
+            Factory.create_large_file_storage(),
+            executor=shared_executor(args.max_workers),
+            max_concurrency=args.max_concurrency,
+            streaming=args.streaming,
+            instrumentation=LoggingInstrumentation(Web.app.logger) if args.log_metrics else Instrumentation(),
+            skip_existing_uploads=not args.no_skip_existing_uploads,
+            verify_upload_size=args.verify_upload_size,
+            verify_endpoint=None if args.no_verify_uploads else Factory.create_endpoint(),
+            part_size=args.part_size,
+            oid_index=Factory.oid_index
+        )
+
+    @staticmethod
+    def create_verify_facade():
+        return VerifyFacade(
+            Factory.create_large_file_storage(),
+            instrumentation=LoggingInstrumentation(Web.app.logger) if args.log_metrics else Instrumentation(),
+            oid_index=Factory.oid_index
         )
 
 
@@ -84,6 +166,56 @@ class Web:
     def objects_batch():
         facade = Factory.create_batch_facade()
 
+        response = facade.process(
+            HttpRequest(
+                path=request.path,
+                method=request.method,
+                headers=request.headers,
+                parameters=request.args,
+                body=iter(lambda: request.stream.read(64 * 1024), b'') if facade.streaming else json.dumps(request.json)
+            )
+        )
+
+        compressor = Factory.response_compressor
+        accept_encoding = request.headers.get('Accept-Encoding')
+        encoding = compressor.negotiate(accept_encoding) if compressor is not None else None
+
+        if facade.streaming:
+            body, headers = response.body.iter_json(), response.headers
+            if encoding is not None:
+                body = compressor.compress_iter(body, encoding)
+                headers = {**headers, **ResponseCompressor.headers(encoding)}
+
+            streaming_response = flask.Response(
+                flask.stream_with_context(body),
+                status=response.status_code,
+                headers=headers
+            )
+            streaming_response.call_on_close(facade.instrumentation.flush)
+            return streaming_response
+
+        with facade.instrumentation.measure('serialize'):
+            body = dataclass_as_dict(response.body)
+
+        if encoding is not None:
+            with facade.instrumentation.measure('compress'):
+                data, encoding = compressor.compress(json.dumps(body).encode(), accept_encoding)
+            if encoding is not None:
+                facade.instrumentation.flush()
+                return flask.Response(
+                    data,
+                    status=response.status_code,
+                    headers={**response.headers, **ResponseCompressor.headers(encoding)}
+                )
+
+        facade.instrumentation.flush()
+        return body, response.status_code, response.headers
+
+    @staticmethod
+    @app.route('/objects/verify', methods=['POST'])
+    def objects_verify():
+        facade = Factory.create_verify_facade()
+
         response = facade.process(
             HttpRequest(
                 path=request.path,
@@ -94,7 +226,11 @@ class Web:
             )
         )
 
-        return dataclass_as_dict(response.body), response.status_code, response.headers
+        with facade.instrumentation.measure('serialize'):
+            body = dataclass_as_dict(response.body)
+
+        facade.instrumentation.flush()
+        return body, response.status_code, response.headers
 
     @staticmethod
     @app.route('/transfer/<oid>', methods=['GET', 'PUT'])
@@ -109,6 +245,10 @@ class Web:
 
         elif request.method == 'PUT':
             lfs.upload(oid)
+            if Factory.existence_cache.enabled:
+                Factory.existence_cache.put(oid, True)
+            if Factory.oid_index is not None:
+                Factory.oid_index.add([oid])
             return '', 202
 
     @staticmethod
@@ -150,9 +290,48 @@ if __name__ == '__main__':
     parser.add_argument('--host', type=str, default='127.0.0.1', help="The hostname to listen on.")
     parser.add_argument('--repo', type=str, required=True, help="Absolute path to Git LFS repository.")
     parser.add_argument('--endpoint', type=str, required=False, default=None, help="Public endpoint address.")
+    parser.add_argument('--max-workers', type=int, default=0,
+                        help="The number of threads used to process batch objects concurrently.")
+    parser.add_argument('--max-concurrency', type=int, default=None,
+                        help="The maximum number of objects of a single batch processed concurrently.")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Stream batch request and response bodies while objects are processed.")
+    parser.add_argument('--exists-cache-size', type=int, default=0,
+                        help="The maximum number of existing objects remembered between requests.")
+    parser.add_argument('--exists-cache-negative-ttl', type=float, default=0,
+                        help="The number of seconds a missing object is remembered.")
+    parser.add_argument('--no-skip-existing-uploads', action='store_true',
+                        help="Return upload actions for objects that are already stored.")
+    parser.add_argument('--verify-upload-size', action='store_true',
+                        help="Request an upload when the stored object size differs.")
+    parser.add_argument('--no-verify-uploads', action='store_true',
+                        help="Omit the verify action from upload responses.")
+    parser.add_argument('--part-size', type=int, default=None,
+                        help="Offer the multipart transfer with parts of this many bytes.")
+    parser.add_argument('--key-layout', type=str, default='sharded', choices=['flat', 'sharded', 'prefixed'],
+                        help="The layout of object paths inside the repository.")
+    parser.add_argument('--key-prefix', type=str, default='', help="The path prefix of the prefixed key layout.")
+    parser.add_argument('--no-compress-responses', action='store_true',
+                        help="Never compress batch responses, regardless of Accept-Encoding.")
+    parser.add_argument('--compress-min-size', type=int, default=1024,
+                        help="The smallest batch response in bytes that is compressed.")
+    parser.add_argument('--oid-index', action='store_true',
+                        help="Answer uploads of definitely absent objects from a Bloom filter of stored oids.")
+    parser.add_argument('--oid-index-path', type=str, default='.lfs/oids.bloom',
+                        help="The path of the oid index snapshot inside the repository.")
+    parser.add_argument('--oid-index-capacity', type=int, default=1000000,
+                        help="The number of oids the oid index is sized for.")
+    parser.add_argument('--log-metrics', action='store_true', help="Log per-phase timings of batch requests.")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode.")
     parser.add_argument('-h', '--help', action='help', default=argparse.SUPPRESS, help='Print this message')
     args = parser.parse_args()
 
+    Factory.existence_cache = ExistenceCache(
+        max_size=args.exists_cache_size,
+        negative_ttl=args.exists_cache_negative_ttl
+    )
+    Factory.response_compressor = None if args.no_compress_responses else ResponseCompressor(args.compress_min_size)
+    Factory.oid_index = Factory.create_oid_index() if args.oid_index else None
+
     web = Web()
     web.app.run(port=args.port, host=args.host, debug=args.debug)
@@ -1,3 +1,7 @@
+import gzip
+import hashlib
+import json
+import tempfile
 import unittest
 from pathlib import Path
 from unittest import mock
@@ -81,6 +85,22 @@ class SimpleLargeFileStorageTestCase(unittest.TestCase):
         # TODO: fix me
         self.fail()
 
+    def test_oid_index_storage(self):
+        oid = hashlib.sha256(b'foo').hexdigest()
+        with tempfile.TemporaryDirectory() as repo:
+            self.lfs.repo = Path(repo)
+            (self.lfs.repo / self.lfs.layout.key(oid)).parent.mkdir(parents=True)
+            (self.lfs.repo / self.lfs.layout.key(oid)).write_bytes(b'foo')
+
+            self.assertEqual(self.lfs.read_object('.lfs/oids.bloom'), (None, None))
+            self.assertTrue(self.lfs.write_object('.lfs/oids.bloom', b'foo', None))
+            self.assertFalse(self.lfs.write_object('.lfs/oids.bloom', b'bar', None))
+            data, etag = self.lfs.read_object('.lfs/oids.bloom')
+            self.assertEqual(data, b'foo')
+            self.assertTrue(self.lfs.write_object('.lfs/oids.bloom', b'barbaz', etag))
+            self.assertFalse(self.lfs.write_object('.lfs/oids.bloom', b'baz', etag))
+            self.assertEqual(list(self.lfs.iter_oids()), [oid])
+
 
 class WebAppTestCase(unittest.TestCase):
 
@@ -126,6 +146,7 @@ class WebAppTestCase(unittest.TestCase):
     def test_objects_batch(self):
         with mock.patch('app.Factory.create_batch_facade') as mock_factory:
             mock_facade = mock.MagicMock()
+            mock_facade.streaming = False
             mock_facade.process.return_value = HttpResponse(BatchResponse('foo', []))
             mock_factory.return_value = mock_facade
 
@@ -134,6 +155,66 @@ class WebAppTestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(response.json, {'objects': [], 'transfer': 'foo'})
 
+    def test_objects_batch_streaming(self):
+        with mock.patch('app.Factory.create_batch_facade') as mock_factory:
+            mock_facade = mock.MagicMock()
+            mock_facade.streaming = True
+            mock_facade.process.return_value = HttpResponse(
+                BatchResponse('basic', (BatchResponse.ObjectLfs(f'oid{i}', i) for i in range(3))),
+                headers={'Content-Type': 'application/vnd.git-lfs+json'}
+            )
+            mock_factory.return_value = mock_facade
+
+            response = self.app.post('/objects/batch', data=b'{}')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Type'], 'application/vnd.git-lfs+json')
+            self.assertIsNone(response.headers.get('Content-Length'))
+            self.assertEqual(response.json, {
+                'transfer': 'basic',
+                'objects': [{'oid': 'oid0', 'size': 0}, {'oid': 'oid1', 'size': 1}, {'oid': 'oid2', 'size': 2}]
+            })
+
+    def test_objects_batch_compressed(self):
+        with mock.patch('app.Factory.create_batch_facade') as mock_factory:
+            mock_facade = mock.MagicMock()
+            mock_facade.streaming = False
+            mock_facade.process.return_value = HttpResponse(
+                BatchResponse('basic', [BatchResponse.ObjectLfs(f'{i:064x}', i) for i in range(100)])
+            )
+            mock_factory.return_value = mock_facade
+
+            response = self.app.post('/objects/batch', json={}, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(len(json.loads(gzip.decompress(response.data))['objects']), 100)
+
+    def test_objects_batch_streaming_compressed(self):
+        with mock.patch('app.Factory.create_batch_facade') as mock_factory:
+            mock_facade = mock.MagicMock()
+            mock_facade.streaming = True
+            mock_facade.process.return_value = HttpResponse(
+                BatchResponse('basic', (BatchResponse.ObjectLfs(f'oid{i}', i) for i in range(3)))
+            )
+            mock_factory.return_value = mock_facade
+
+            response = self.app.post('/objects/batch', data=b'{}', headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(response.data))['objects'][2], {'oid': 'oid2', 'size': 2})
+
+    def test_objects_verify(self):
+        with mock.patch('app.Factory.create_verify_facade') as mock_factory:
+            mock_facade = mock.MagicMock()
+            mock_facade.process.return_value = HttpResponse(VerifyRequest('foo', 123))
+            mock_factory.return_value = mock_facade
+
+            response = self.app.post('/objects/verify', json={'oid': 'foo', 'size': 123})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json, {'oid': 'foo', 'size': 123})
+            self.assertEqual(mock_facade.process.call_args[0][0].path, '/objects/verify')
+
     def test_transfer_get_not_found(self):
         with mock.patch('app.Factory.create_large_file_storage') as mock_factory:
             mock_lfs = mock.MagicMock()
@@ -170,3 +251,21 @@ class WebAppTestCase(unittest.TestCase):
             self.assertEqual(response.status_code, 202)
             self.assertEqual(response.data, b'')
             mock_lfs.upload.assert_called_once_with('123')
+
+    def test_transfer_put_existence_cache(self):
+        with mock.patch('app.Factory.create_large_file_storage'), \
+                mock.patch('app.Factory.existence_cache', ExistenceCache(negative_ttl=60)) as cache:
+            cache.put('123', False)
+
+            response = self.app.put('/transfer/123')
+
+            self.assertEqual(response.status_code, 202)
+            self.assertIsNone(cache.get('123'))
+
+    def test_transfer_put_oid_index(self):
+        with mock.patch('app.Factory.create_large_file_storage'), \
+                mock.patch('app.Factory.oid_index') as mock_oid_index:
+            response = self.app.put('/transfer/123')
+
+            self.assertEqual(response.status_code, 202)
+            mock_oid_index.add.assert_called_once_with(['123'])
@@ -64,7 +64,9 @@ data "aws_iam_policy_document" "lambda_role_policy" {
     actions = [
       "s3:GetObject",
       "s3:PutObject",
-      "s3:ListBucket"
+      "s3:ListBucket",
+      "s3:ListMultipartUploadParts",
+      "s3:AbortMultipartUpload"
     ]
 
     resources = [
@@ -93,6 +95,21 @@ resource "aws_iam_role_policy" "lambda_role_policy" {
   policy      = data.aws_iam_policy_document.lambda_role_policy.json
 }
 
+resource "aws_s3_bucket_lifecycle_configuration" "bucket_lifecycle" {
+  bucket = var.bucket_name
+
+  rule {
+    id     = "abort-incomplete-multipart-uploads"
+    status = "Enabled"
+
+    filter {}
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = var.multipart_upload_expiration_days
+    }
+  }
+}
+
 resource "aws_cloudwatch_log_group" "lambda_log_group" {
   name              = "/aws/lambda/${local.resource_name_prefix}-api"
   retention_in_days = 7
@@ -25,6 +25,12 @@ variable "bucket_name" {
   description = "S3 bucket name where will be stored Git LFS objects"
 }
 
+variable "multipart_upload_expiration_days" {
+  type        = number
+  description = "Days after which S3 aborts multipart uploads that were never completed"
+  default     = 1
+}
+
 variable "tags" {
   type        = map(string)
   description = "A list of tags to apply to resources"